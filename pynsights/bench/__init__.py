@@ -0,0 +1,76 @@
+"""
+Benchmarks that measure what recording costs.
+
+Every workload runs in a fresh interpreter, once without recording and
+once for each recorder configuration, so the recorder's global state
+never leaks from one run into the next.
+"""
+
+import json
+import subprocess
+import sys
+
+from pynsights.bench.workloads import WORKLOADS
+
+CONFIGURATIONS = {
+    "setprofile": {"backend": "setprofile"},
+    "monitoring": {"backend": "monitoring"},
+    "per-call": {"call_bucket": 0},
+    "binary": {"format": "binary"},
+    "sample": {"mode": "sample"},
+}
+
+
+def get_configurations():
+    configurations = dict(CONFIGURATIONS)
+    if not hasattr(sys, "monitoring"):
+        del configurations["monitoring"]
+    return configurations
+
+
+def run_once(workload, config, scale):
+    command = [sys.executable, "-m", "pynsights.bench.runner", workload, json.dumps(config), str(scale)]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return json.loads(result.stdout.decode("utf8").strip().splitlines()[-1])
+
+
+def run_best(workload, config, scale, repeat):
+    # the fastest run has the least noise from the rest of the machine
+    return min((run_once(workload, config, scale) for _ in range(repeat)), key=lambda run: run["seconds"])
+
+
+def run_benchmarks(workloads=None, configurations=None, scale=1.0, repeat=3):
+    """Return a list of results, one per workload and recorder configuration."""
+    available = get_configurations()
+    results = []
+    for workload in workloads or WORKLOADS:
+        baseline = run_best(workload, None, scale, repeat)
+        for name in configurations or available:
+            run = run_best(workload, available[name], scale, repeat)
+            results.append({
+                "workload": workload,
+                "configuration": name,
+                "calls": run["calls"],
+                "baseline_seconds": round(baseline["seconds"], 4),
+                "seconds": round(run["seconds"], 4),
+                "slowdown": round(run["seconds"] / baseline["seconds"], 2),
+                "overhead_ns_per_call": round((run["seconds"] - baseline["seconds"]) * 1e9 / max(1, run["calls"])),
+                "bytes_per_second": round(run["bytes"] / run["seconds"]),
+                "extra_peak_rss": run["peak_rss"] - baseline["peak_rss"],
+            })
+    return results
+
+
+def format_results(results):
+    from pynsights.render import format_bytes
+    lines = ["%-10s %-12s %10s %12s %12s %12s" % ("workload", "config", "slowdown", "ns/call", "written/s", "extra rss")]
+    for result in results:
+        lines.append("%-10s %-12s %9.2fx %12s %12s %12s" % (
+            result["workload"],
+            result["configuration"],
+            result["slowdown"],
+            f"{result['overhead_ns_per_call']:,}",
+            format_bytes(result["bytes_per_second"]),
+            format_bytes(max(0, result["extra_peak_rss"])),
+        ))
+    return "\n".join(lines)
@@ -0,0 +1,7 @@
+def decode(request):
+    key, _, value = request.partition("=")
+    return key, value or None
+
+
+def encode(key, value):
+    return "%s=%s" % (key, value)
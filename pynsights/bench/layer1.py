@@ -0,0 +1,7 @@
+from pynsights.bench import layer2
+
+
+def call(depth):
+    if depth <= 0:
+        return 0
+    return 1 + layer2.call(depth - 1)
@@ -0,0 +1,55 @@
+"""
+Run one benchmark workload in this process, optionally under a recorder
+configuration, and print its measurements as JSON.
+
+Usage: python -m pynsights.bench.runner WORKLOAD CONFIG_JSON SCALE
+"""
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pynsights
+from pynsights.bench.workloads import WORKLOADS
+
+
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().rss
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run(workload, config, scale):
+    fd, output = tempfile.mkstemp(suffix=".trace")
+    os.close(fd)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if config is None:
+                start = time.perf_counter()
+                calls = WORKLOADS[workload](scale)
+                elapsed = time.perf_counter() - start
+            else:
+                with pynsights.Recorder(output, **config):
+                    start = time.perf_counter()
+                    calls = WORKLOADS[workload](scale)
+                    elapsed = time.perf_counter() - start
+        return {
+            "calls": calls,
+            "seconds": elapsed,
+            "bytes": os.path.getsize(output),
+            "peak_rss": get_peak_rss(),
+        }
+    finally:
+        os.remove(output)
+
+
+if __name__ == "__main__":
+    workload, config, scale = sys.argv[1], json.loads(sys.argv[2]), float(sys.argv[3])
+    print(json.dumps(run(workload, config, scale)))
@@ -0,0 +1,15 @@
+"""
+A tiny request handler that talks to a codec and a store module, like a call-heavy microservice.
+"""
+
+from pynsights.bench import codec
+from pynsights.bench import store
+
+
+def handle(request):
+    key, value = codec.decode(request)
+    if value is None:
+        value = store.get(key)
+    else:
+        store.put(key, value)
+    return codec.encode(key, value)
@@ -0,0 +1,9 @@
+data = {}
+
+
+def get(key):
+    return data.get(key)
+
+
+def put(key, value):
+    data[key] = value
@@ -0,0 +1,55 @@
+"""
+Synthetic workloads for the recorder benchmarks.
+
+Each workload takes a scale factor and returns the number of
+cross-module calls it made, which is what the recorder has to handle.
+"""
+
+import threading
+
+from pynsights.bench import layer1
+from pynsights.bench import service
+
+CHAIN_DEPTH = 30
+THREAD_COUNT = 8
+
+
+def run_chain(scale):
+    calls = 0
+    for _ in range(int(5000 * scale)):
+        calls += layer1.call(CHAIN_DEPTH)
+    return calls
+
+
+def run_service(scale, requests=None):
+    count = requests or int(50000 * scale)
+    for n in range(count):
+        service.handle("key%d=%d" % (n % 100, n) if n % 3 else "key%d" % (n % 100))
+    return count * 4
+
+
+def run_threads(scale):
+    requests = int(50000 * scale / THREAD_COUNT)
+    threads = [threading.Thread(target=run_service, args=(scale, requests)) for _ in range(THREAD_COUNT)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return requests * THREAD_COUNT * 4
+
+
+def run_alloc(scale):
+    from pynsights.bench import codec
+    from pynsights.bench import store
+    count = int(50000 * scale)
+    for n in range(count):
+        store.put(n % 10000, [codec.encode(n, m) for m in range(10)])
+    return count * 11
+
+
+WORKLOADS = {
+    "chain": run_chain,
+    "service": run_service,
+    "threads": run_threads,
+    "alloc": run_alloc,
+}
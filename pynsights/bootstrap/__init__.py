@@ -0,0 +1,3 @@
+"""
+The sitecustomize that starts recording in child interpreters.
+"""
@@ -0,0 +1,19 @@
+"""
+Start recording in interpreters spawned by a program recorded with --follow-children.
+"""
+
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+if "PYNSIGHTS_CHILD" in os.environ:
+    from pynsights.record import start_child
+    start_child()
+
+# this module hides any other sitecustomize, so run that one as well
+here = os.path.dirname(os.path.abspath(__file__))
+paths = [path for path in sys.path if os.path.abspath(path or os.getcwd()) != here]
+spec = importlib.machinery.PathFinder.find_spec("sitecustomize", paths)
+if spec:
+    spec.loader.exec_module(importlib.util.module_from_spec(spec))
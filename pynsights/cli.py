@@ -14,6 +14,7 @@
 from __future__ import annotations
 
 import argparse
+import json
 import sys
 import tempfile
 from contextlib import suppress
@@ -22,7 +23,25 @@ from runpy import run_module, run_path
 import urllib
 
 from pynsights import Recorder
-from pynsights.render import render, render_remote
+from pynsights.diff import diff, format_report
+from pynsights.export import EXPORT_FORMATS, export
+from pynsights.index import build_index, get_index_filename
+from pynsights.record import metric_intervals
+from pynsights.render import follow_remote, parse_time, render, render_remote
+from pynsights.tracefile import COMPRESSIONS, FORMATS, convert
+
+
+def parse_metric_interval(option: str) -> tuple[str, float]:
+    name, _, seconds = option.partition("=")
+    try:
+        if name not in metric_intervals:
+            raise ValueError()
+        seconds = float(seconds)
+        if seconds < 0:
+            raise ValueError()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected NAME=SECONDS with seconds 0 or more and NAME one of {', '.join(metric_intervals)}, got '{option}'")
+    return name, seconds
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -51,22 +70,74 @@ def get_parser() -> argparse.ArgumentParser:
 
     record_parser = subparser("record", "Record the interactions within the execution of a Python program.")
     record_parser.add_argument("-o", "--output", type=Path, default=None, help="Output path of the recorded data.")
+    record_parser.add_argument("-b", "--backend", choices=["monitoring", "setprofile"], default=None, help="How calls are recorded (default: setprofile, monitoring needs Python 3.12+).")
+    record_parser.add_argument("-f", "--format", choices=FORMATS, default=None, help="Trace file format (default: text).")
+    record_parser.add_argument("-z", "--compress", dest="compression", choices=COMPRESSIONS, default=None, help="Compress the data file in frames that survive a crash (default: none).")
+    record_parser.add_argument("--follow-children", dest="follow_children", action="store_true", help="Also record child processes, each into its own data file next to the output.")
+    record_parser.add_argument("--asyncio", action="store_true", help="Follow coroutines across awaits, and show how long each one blocked the event loop.")
+    record_parser.add_argument("--blocking", action="store_true", help="Record how long threads wait in Lock.acquire, Queue.get, and similar calls.")
+    record_parser.add_argument("--span-threshold", dest="span_threshold", type=float, default=None, help="Show calls that take longer than this many milliseconds as spans (default: 100).")
+    record_parser.add_argument("--top-spans", dest="top_spans", type=int, default=None, help="Keep at most this many of the slowest spans per callsite every second (default: 10).")
+    record_parser.add_argument("--sample-hz", dest="sample_hz", type=int, default=None, help="Sample all stacks this many times per second instead of recording every call.")
+    record_parser.add_argument("--call-bucket", dest="call_bucket", type=float, default=None, help="Seconds to count calls per callsite before writing them, 0 to write every call (default: 0.5).")
+    record_parser.add_argument("--heap", choices=["gc", "sample", "tracemalloc", "muppy"], default=None, help="How heap snapshots are taken (default: gc).")
+    record_parser.add_argument("--heap-budget", dest="heap_budget", type=float, default=None, help="Seconds a heap snapshot may take (default: 0.05).")
+    record_parser.add_argument("--metric-interval", dest="metric_intervals", type=parse_metric_interval, action="append", default=[], metavar="NAME=SECONDS", help="How often to measure memory, cpu, threads, io, pressure, or heap; 0 turns it off.")
     record_parser.add_argument("record_command", nargs="+", help="The Python script/module to run and its options.")
 
     render_parser = subparser("render", "Render the given data file into a standalone HTML file.")
     render_parser.add_argument("-w", "--browser", "--open", dest="browser", action="store_true", help="Open the HTML file in your default browser.")
-    render_parser.add_argument("input_file", type=Path, help="The input data file to render.")
+    render_parser.add_argument("input_file", type=Path, help="The input data file to render, or - to read it from stdin.")
     render_parser.add_argument("-o", "--output", type=Path, default=None, help="Output path of the standalone HTML.")
+    render_parser.add_argument("--from", dest="start", default=None, help="Only render events from this time on, such as 120s or 2m.")
+    render_parser.add_argument("--to", dest="end", default=None, help="Only render events up to this time, such as 150s.")
+    render_parser.add_argument("-j", "--jobs", type=int, default=1, help="Parse an indexed data file with this many processes.")
 
     run_parser = subparser("run", "Record and render in one go.")
     run_parser.add_argument("-w", "--browser", "--open", dest="browser", action="store_true", help="Open the HTML file in your default browser.")
     run_parser.add_argument("-o", "--output", type=Path, default=None, help="Output path of the final HTML file.")
     run_parser.add_argument("record_command", nargs="+", help="The Python script/module to run and its options.")
 
+    index_parser = subparser("index", "Write a sidecar index that lets render seek into the given data file.")
+    index_parser.add_argument("input_file", type=Path, help="The data file to index.")
+
+    convert_parser = subparser("convert", "Convert a data file between the text and binary formats.")
+    convert_parser.add_argument("input_file", type=Path, help="The input data file to convert.")
+    convert_parser.add_argument("output_file", type=Path, help="Output path of the converted data file.")
+    convert_parser.add_argument("-f", "--format", choices=FORMATS, default="binary", help="Format to convert to (default: binary).")
+    convert_parser.add_argument("-z", "--compress", dest="compression", choices=COMPRESSIONS, default="none", help="Compression to convert to (default: none).")
+
+    diff_parser = subparser("diff", "Compare two data files of the same program and report what changed.")
+    diff_parser.add_argument("old_file", type=Path, help="The data file of the baseline run.")
+    diff_parser.add_argument("new_file", type=Path, help="The data file of the run to compare.")
+    diff_parser.add_argument("--json", dest="json", action="store_true", help="Print the report as JSON.")
+    diff_parser.add_argument("-n", "--limit", type=int, default=20, help="Show this many of the largest changes of each kind.")
+    diff_parser.add_argument("-o", "--output", type=Path, default=None, help="Also write an HTML graph of the new run with edges colored by change.")
+    diff_parser.add_argument("-w", "--browser", "--open", dest="browser", action="store_true", help="Open the HTML file in your default browser.")
+
+    stats_parser = subparser("stats", "Print the top callsites, hotspots, modules, and heap types of a data file.")
+    stats_parser.add_argument("input_file", type=Path, help="The data file to summarize, or - to read it from stdin.")
+    stats_parser.add_argument("--json", dest="json", action="store_true", help="Print the stats as JSON.")
+    stats_parser.add_argument("-n", "--limit", type=int, default=20, help="Show this many of the largest items of each kind.")
+
+    export_parser = subparser("export", "Convert a data file for the Chrome trace viewer, speedscope, or pprof.")
+    export_parser.add_argument("input_file", type=Path, help="The data file to export.")
+    export_parser.add_argument("-f", "--format", choices=EXPORT_FORMATS, default="chrome", help="Format to export to (default: chrome).")
+    export_parser.add_argument("-o", "--output", type=Path, default=None, help="Output path of the exported file.")
+
+    bench_parser = subparser("bench", "Measure the overhead of recording on synthetic workloads.")
+    bench_parser.add_argument("-w", "--workload", dest="workloads", action="append", choices=["chain", "service", "threads", "alloc"], help="Workload to run, can be repeated (default: all).")
+    bench_parser.add_argument("-c", "--config", dest="configurations", action="append", choices=["setprofile", "monitoring", "per-call", "binary", "sample"], help="Recorder configuration to measure, can be repeated (default: all).")
+    bench_parser.add_argument("-s", "--scale", type=float, default=1.0, help="Multiply the size of every workload.")
+    bench_parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per measurement, the fastest one counts.")
+    bench_parser.add_argument("--json", dest="json", action="store_true", help="Print the results as JSON.")
+
     remote_parser = subparser("remote", "Live-connect to a remote Python program.")
     remote_parser.add_argument("-s", "--start", dest="start", action="store_true", help="Start recording.")
     remote_parser.add_argument("-c", "--cancel", dest="cancel", action="store_true", help="Cancel recording.")
     remote_parser.add_argument("-r", "--render", dest="render", action="store_true", help="Render the latest recording.")
+    remote_parser.add_argument("-f", "--follow", dest="follow", action="store_true", help="Render the recording while it grows.")
+    remote_parser.add_argument("--refresh", dest="refresh", type=float, default=5, help="Seconds between renders when following.")
     remote_parser.add_argument("-x", "--exit", dest="exit", action="store_true", help="Exit the remote process.")
     remote_parser.add_argument("-w", "--browser", dest="browser", action="store_true", help="Open the HTML file in your default browser.")
     remote_parser.add_argument("host_details", nargs="+", help="The hostname and port number for the remote process.")
@@ -74,7 +145,7 @@ def get_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def do_record(command, output=None):
+def do_record(command, output=None, backend=None, format=None, sample_hz=None, call_bucket=None, heap=None, heap_budget=None, metric_intervals=None, compression=None, follow_children=False, asyncio=False, blocking=False, span_threshold=None, top_spans=None):
     module = command[0]
     if Path(module).exists():
         runpy = run_path
@@ -83,18 +154,28 @@ def do_record(command, output=None):
     
     sys.argv = command
     with suppress(SystemExit):
-        with Recorder(output):
+        with Recorder(output, backend, format, sample_hz=sample_hz, call_bucket=call_bucket, heap=heap, heap_budget=heap_budget, metric_intervals=metric_intervals, compression=compression, follow_children=follow_children, asyncio=asyncio, blocking=blocking, span_threshold=span_threshold, top_spans=top_spans):
             runpy(module, run_name="__main__")
 
 
-def do_render(input_file, output_file, open_browser):
-    render(input_file, output_file, open_browser)
+def do_render(input_file, output_file, open_browser, start=None, end=None, jobs=1):
+    start = None if start is None else parse_time(start)
+    end = None if end is None else parse_time(end)
+    render(input_file, output_file, open_browser, start, end, jobs)
+
+
+def do_index(input_file):
+    index = build_index(input_file)
+    print(f"Pynsights: wrote {len(index['checkpoints'])} checkpoints to {get_index_filename(input_file)}")
 
 
-def do_remote(host_details, start=False, cancel=False, render=False, exit=False, open_browser=False):
+def do_remote(host_details, start=False, cancel=False, render=False, exit=False, open_browser=False, follow=False, refresh=5):
     host_name, port_number = host_details
     url = f"http://{host_name}:{port_number}/"
-    if render:
+    if follow:
+        output = Path(tempfile.gettempdir(), "trace.html")
+        follow_remote(url + "follow", output, open_browser, refresh)
+    elif render:
         output = Path(tempfile.gettempdir(), "trace.html")
         render_remote(url + "trace", output, open_browser)
     elif start:
@@ -105,6 +186,28 @@ def do_remote(host_details, start=False, cancel=False, render=False, exit=False,
         print(urllib.request.urlopen(url + "exit").read())
 
 
+def do_diff(old_file, new_file, as_json=False, limit=20, output=None, open_browser=False):
+    report = diff(old_file, new_file, output, open_browser)
+    print(json.dumps(report, indent=4) if as_json else format_report(report, limit))
+
+
+def do_stats(input_file, as_json=False, limit=20):
+    from pynsights.stats import format_stats, stats
+    result = stats(input_file, limit)
+    print(json.dumps(result, indent=4) if as_json else format_stats(result))
+
+
+def do_export(input_file, format="chrome", output=None):
+    output = export(input_file, output, format)
+    print(f"Pynsights: wrote {output}")
+
+
+def do_bench(workloads=None, configurations=None, scale=1.0, repeat=3, as_json=False):
+    from pynsights.bench import format_results, run_benchmarks
+    results = run_benchmarks(workloads, configurations, scale, repeat)
+    print(json.dumps(results, indent=4) if as_json else format_results(results))
+
+
 def do_run(command, output=None, open_browser=False):
     tmpname = Path(command[0]).stem
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -129,19 +232,44 @@ def main(args: list[str] | None = None) -> int:
     opts = parser.parse_args(args)
 
     if opts.command == "record":
-        do_record(opts.record_command, opts.output)
+        intervals = dict(opts.metric_intervals)
+        do_record(opts.record_command, opts.output, opts.backend, opts.format, opts.sample_hz, opts.call_bucket, opts.heap, opts.heap_budget, intervals, opts.compression, opts.follow_children, opts.asyncio, opts.blocking, opts.span_threshold, opts.top_spans)
         return 0
     
     if opts.command == "render":
-        do_render(opts.input_file, opts.output, opts.browser)
+        do_render(opts.input_file, opts.output, opts.browser, opts.start, opts.end, opts.jobs)
         return 0
 
     if opts.command == "run":
         do_run(opts.record_command, opts.output, opts.browser)
         return 0
 
+    if opts.command == "index":
+        do_index(opts.input_file)
+        return 0
+
+    if opts.command == "convert":
+        convert(opts.input_file, opts.output_file, opts.format, opts.compression)
+        return 0
+
+    if opts.command == "diff":
+        do_diff(opts.old_file, opts.new_file, opts.json, opts.limit, opts.output, opts.browser)
+        return 0
+
+    if opts.command == "stats":
+        do_stats(opts.input_file, opts.json, opts.limit)
+        return 0
+
+    if opts.command == "export":
+        do_export(opts.input_file, opts.format, opts.output)
+        return 0
+
+    if opts.command == "bench":
+        do_bench(opts.workloads, opts.configurations, opts.scale, opts.repeat, opts.json)
+        return 0
+
     if opts.command == "remote":
-        do_remote(opts.host_details, opts.start, opts.cancel, opts.render, opts.exit, opts.browser)
+        do_remote(opts.host_details, opts.start, opts.cancel, opts.render, opts.exit, opts.browser, opts.follow, opts.refresh)
         return 0
     
     if opts.command:
@@ -11,3 +11,55 @@ EVENT_HEAP = 9
 EVENT_GC = 10
 EVENT_TIMESTAMP = 11
 EVENT_RETURN = 12
+EVENT_DROPPED = 13
+EVENT_CALLS = 14
+EVENT_BUCKET = 15
+EVENT_THREADS = 16
+EVENT_SWITCHES = 17
+EVENT_IO = 18
+EVENT_FDS = 19
+EVENT_PRESSURE = 20
+EVENT_OVERHEAD = 21
+EVENT_ASYNC_RETURN = 22
+EVENT_LANE = 23
+EVENT_THREAD_NAME = 24
+EVENT_BLOCKED = 25
+EVENT_CLOCK = 26
+EVENT_LATENCY = 27
+
+# timestamps and durations are in milliseconds unless a CLOCK event gives their ticks per second
+CLOCK_MILLISECONDS = 1000
+
+# Fields of each event, used to encode and decode traces:
+#   u = unsigned int, i = signed int, d = float, s = string (rest of the line in text traces),
+#   t = timestamp (delta-encoded in binary traces), L = list of unsigned ints (rest of the line)
+EVENT_FIELDS = {
+    EVENT_MODULE: "s",
+    EVENT_CALLSITE: "uu",
+    EVENT_CALL: "u",
+    EVENT_ANNOTATE: "s",
+    EVENT_ENTER: "s",
+    EVENT_EXIT: "s",
+    EVENT_CPU: "dd",
+    EVENT_MEMORY: "d",
+    EVENT_TYPE: "s",
+    EVENT_HEAP: "s",
+    EVENT_GC: "uuu",
+    EVENT_TIMESTAMP: "t",
+    EVENT_RETURN: "uus",
+    EVENT_DROPPED: "u",
+    EVENT_CALLS: "uu",
+    EVENT_BUCKET: "L",
+    EVENT_THREADS: "u",
+    EVENT_SWITCHES: "uu",
+    EVENT_IO: "uuuu",
+    EVENT_FDS: "u",
+    EVENT_PRESSURE: "dd",
+    EVENT_OVERHEAD: "uuuuuuu",
+    EVENT_ASYNC_RETURN: "uuuss",
+    EVENT_LANE: "u",
+    EVENT_THREAD_NAME: "us",
+    EVENT_BLOCKED: "us",
+    EVENT_CLOCK: "u",
+    EVENT_LATENCY: "uuuL",
+}
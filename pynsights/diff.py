@@ -0,0 +1,208 @@
+"""
+Compare two recordings of the same program and report what changed.
+
+Modules and callsites are matched by name, because their indexes only
+reflect the order in which a run happened to use them first.
+"""
+
+import json
+import sys
+
+from pynsights.constants import *
+from pynsights.render import MODULES_TO_SKIP, TraceModel, format_bytes, open_ui
+from pynsights.tracefile import read_events
+
+HEAP_TOTAL = "Total#Heap#Size#and#Count"
+
+
+class TraceSummary(object):
+    """
+    The totals of one trace: calls and latencies per callsite, hotspots per
+    function, GC pauses, peak memory, and the last heap snapshot, by name.
+    """
+
+    def __init__(self):
+        self.modulenames = []
+        self.callsites = []
+        self.typenames = []
+        self.calls = {}
+        self.spans = {}
+        self.latencies = {}
+        self.heap = {}
+        self.total_calls = 0
+        self.gc_count = 0
+        self.gc_pause = 0
+        self.gc_max = 0
+        self.memory_peak = 0
+        self.first_when = 0
+        self.scale = 1
+        self.when = 0
+
+    def get_callsite(self, index):
+        source, target = [self.modulenames[module] for module in self.callsites[index]]
+        if source not in MODULES_TO_SKIP and target not in MODULES_TO_SKIP:
+            return source, target
+
+    def add_calls(self, index, count):
+        callsite = self.get_callsite(index)
+        if callsite:
+            self.calls[callsite] = self.calls.get(callsite, 0) + count
+            self.total_calls += count
+
+    def add_span(self, index, duration, function):
+        callsite = self.get_callsite(index)
+        if callsite:
+            key = callsite + (function,)
+            count, total, longest = self.spans.get(key, (0, 0, 0))
+            duration *= self.scale
+            self.spans[key] = count + 1, total + duration, max(longest, duration)
+
+    def add_latency(self, index, count, total):
+        callsite = self.get_callsite(index)
+        if callsite:
+            old_count, old_total = self.latencies.get(callsite, (0, 0))
+            self.latencies[callsite] = old_count + count, old_total + total * self.scale
+
+    def handle_event(self, kind, items):
+        if kind == EVENT_CALL:
+            self.add_calls(items[0], 1)
+        elif kind == EVENT_CALLS:
+            self.add_calls(*items)
+        elif kind == EVENT_BUCKET:
+            pairs = items[0]
+            for n in range(0, len(pairs), 2):
+                self.add_calls(pairs[n], pairs[n + 1])
+        elif kind == EVENT_RETURN:
+            self.add_span(*items)
+        elif kind == EVENT_ASYNC_RETURN:
+            index, wall, _, function, _ = items
+            self.add_span(index, wall, function)
+        elif kind == EVENT_LATENCY:
+            self.add_latency(*items[:3])
+        elif kind == EVENT_MODULE:
+            self.modulenames.append(items[0])
+        elif kind == EVENT_CALLSITE:
+            self.callsites.append(tuple(items))
+        elif kind == EVENT_TYPE:
+            self.typenames.append(items[0])
+        elif kind == EVENT_GC:
+            duration = items[0] * self.scale
+            self.gc_count += 1
+            self.gc_pause += duration
+            self.gc_max = max(self.gc_max, duration)
+        elif kind == EVENT_MEMORY:
+            self.memory_peak = max(self.memory_peak, items[0])
+        elif kind == EVENT_HEAP:
+            # the last snapshot counts, earlier ones only show how the heap got there
+            self.heap = {
+                self.typenames[index]: (count, size)
+                for index, count, size in json.loads(items[0])
+                if index < len(self.typenames)
+            }
+        elif kind == EVENT_TIMESTAMP:
+            self.first_when = self.first_when or items[0]
+            self.when = round((items[0] - self.first_when) * self.scale)
+        elif kind == EVENT_CLOCK:
+            self.scale = CLOCK_MILLISECONDS / items[0]
+
+
+def summarize(input_file, model=None):
+    """Read the trace once into a TraceSummary, and also into model when given."""
+    print(f"Summarizing {input_file}", file=sys.stderr)
+    summary = TraceSummary()
+    with open(input_file, "rb") as fp:
+        for kind, values in read_events(fp):
+            summary.handle_event(kind, values)
+            if model:
+                model.handle_event(kind, values)
+    if model:
+        model.flush_call_sites()
+    return summary
+
+
+def get_change(old, new):
+    return {"old": old, "new": new, "delta": new - old}
+
+
+def compare(old, new):
+    """Return the differences between two summaries as a dict that can be written as JSON."""
+    callsites = [
+        dict(source=source, target=target, **get_change(old.calls.get((source, target), 0), new.calls.get((source, target), 0)))
+        for source, target in set(old.calls) | set(new.calls)
+    ]
+    hotspots = []
+    for key in set(old.spans) | set(new.spans):
+        old_count, old_total, old_max = old.spans.get(key, (0, 0, 0))
+        new_count, new_total, new_max = new.spans.get(key, (0, 0, 0))
+        source, target, function = key
+        hotspots.append(dict(source=source, target=target, function=function,
+            count=get_change(old_count, new_count),
+            duration=get_change(old_total, new_total),
+            longest=get_change(old_max, new_max)))
+    heap = []
+    for typename in set(old.heap) | set(new.heap):
+        if typename != HEAP_TOTAL:
+            old_count, old_size = old.heap.get(typename, (0, 0))
+            new_count, new_size = new.heap.get(typename, (0, 0))
+            heap.append(dict(type=typename, count=get_change(old_count, new_count), size=get_change(old_size, new_size)))
+    return {
+        "duration": get_change(old.when, new.when),
+        "calls": get_change(old.total_calls, new.total_calls),
+        "gc": {
+            "count": get_change(old.gc_count, new.gc_count),
+            "pause": get_change(old.gc_pause, new.gc_pause),
+            "longest": get_change(old.gc_max, new.gc_max),
+        },
+        "memory": get_change(old.memory_peak, new.memory_peak),
+        "heap_total": get_change(*[summary.heap.get(HEAP_TOTAL, (0, 0))[1] for summary in (old, new)]),
+        "callsites": sorted(callsites, key=lambda change: -abs(change["delta"])),
+        "hotspots": sorted(hotspots, key=lambda change: -abs(change["duration"]["delta"])),
+        "heap": sorted(heap, key=lambda change: -abs(change["size"]["delta"])),
+    }
+
+
+def format_change(change, format=lambda value: f"{value:,}"):
+    old, new, delta = change["old"], change["new"], change["delta"]
+    percent = f" ({delta * 100 / old:+.0f}%)" if old else " (new)" if new else ""
+    return f"{format(old)} -> {format(new)}{percent}"
+
+
+def format_report(report, limit=20):
+    """Return the report as text, with the largest changes of each kind first."""
+    milliseconds = lambda value: f"{round(value, 1):,}ms"
+    gc = report["gc"]
+    lines = [
+        f"Duration       {format_change(report['duration'], milliseconds)}",
+        f"Calls          {format_change(report['calls'])}",
+        f"GC pauses      {format_change(gc['count'])}, total {format_change(gc['pause'], milliseconds)}, longest {format_change(gc['longest'], milliseconds)}",
+        f"Peak memory    {format_change(report['memory'], lambda value: format_bytes(round(value)))}",
+        f"Heap size      {format_change(report['heap_total'], format_bytes)}",
+        "",
+        "Calls per callsite:",
+    ]
+    for change in report["callsites"][:limit]:
+        if change["delta"]:
+            lines.append(f"  {change['delta']:+,}  {change['source']} -> {change['target']}  {format_change(change)}")
+    lines += ["", "Hotspots:"]
+    for change in report["hotspots"][:limit]:
+        lines.append(f"  {change['source']} -> {change['target']} {change['function']}:"
+                     f" {format_change(change['duration'], milliseconds)} in {format_change(change['count'])} calls,"
+                     f" longest {format_change(change['longest'], milliseconds)}")
+    lines += ["", "Heap types:"]
+    for change in report["heap"][:limit]:
+        lines.append(f"  {change['type']}: {format_change(change['size'], format_bytes)} in {format_change(change['count'])} objects")
+    return "\n".join(lines)
+
+
+def diff(old_file, new_file, html=None, open_browser=False):
+    """Compare two traces, and draw the graph of the new one with its edges colored by change when html is given."""
+    model = TraceModel() if html else None
+    old = summarize(old_file)
+    new = summarize(new_file, model)
+    report = compare(old, new)
+    if html:
+        changes = {f"{change['source']} {change['target']}": [change["old"], change["new"]] for change in report["callsites"]}
+        model.generate(html, diffs=changes)
+        if open_browser:
+            open_ui(html)
+    return report
@@ -0,0 +1,379 @@
+"""
+Export a trace to the formats of other profile viewers.
+
+Chrome Trace Event files hold every span, wait, GC pause, and measurement
+with its timestamp. Speedscope and pprof files hold the number of calls and
+the time spent per stack.
+
+Stacks are made of modules, the way Pynsights attributes calls: the calling
+module, the called module, and for spans the function that was called.
+"""
+
+import gzip
+import json
+import sys
+
+from pynsights.constants import *
+from pynsights.render import MODULES_TO_SKIP
+from pynsights.tracefile import read_events, read_shards, write_varint
+
+EXPORT_FORMATS = ["chrome", "speedscope", "pprof"]
+EXPORT_SUFFIXES = {"chrome": ".trace.json", "speedscope": ".speedscope.json", "pprof": ".pb.gz"}
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+GC_LANE = -1 # a collection stops every thread, so its pauses get a track of their own
+
+
+class Exporter(object):
+    """
+    Follows the definitions, clock, and lanes of one or more traces, and hands
+    their records to the add_ methods, with times in microseconds.
+    """
+
+    def __init__(self):
+        self.first_when = 0
+        self.duration = 0
+
+    def read(self, events, process, label, first_when=0):
+        self.first_when = first_when
+        self.process = process
+        self.label = label
+        self.modulenames = []
+        self.callsites = []
+        self.threadnames = {}
+        self.micros = 1000
+        self.lane = 0
+        self.when = 0
+        self.add_process()
+        for kind, values in events:
+            self.handle_event(kind, values)
+        self.add_timestamp()
+
+    def get_callsite(self, index):
+        if index < len(self.callsites):
+            source, target = [self.modulenames[module] for module in self.callsites[index]]
+            if source not in MODULES_TO_SKIP and target not in MODULES_TO_SKIP:
+                return source, target
+
+    def get_thread_name(self, lane=None):
+        lane = self.lane if lane is None else lane
+        return self.threadnames.get(lane, f"Thread {lane}")
+
+    def handle_event(self, kind, items):
+        micros = self.micros
+        if kind == EVENT_MODULE:
+            self.modulenames.append(items[0])
+        elif kind == EVENT_CALLSITE:
+            self.callsites.append(tuple(items))
+        elif kind == EVENT_CALL:
+            self.add_calls(items[0], 1)
+        elif kind == EVENT_CALLS:
+            self.add_calls(*items)
+        elif kind == EVENT_BUCKET:
+            pairs = items[0]
+            for n in range(0, len(pairs), 2):
+                self.add_calls(pairs[n], pairs[n + 1])
+        elif kind == EVENT_RETURN:
+            callsite, duration, codename = items
+            self.add_span(callsite, duration * micros, duration * micros, codename, "")
+        elif kind == EVENT_ASYNC_RETURN:
+            callsite, wall, cpu, codename, task = items
+            self.add_span(callsite, wall * micros, cpu * micros, codename, task)
+        elif kind == EVENT_BLOCKED:
+            duration, name = items
+            self.add_wait(duration * micros, name)
+        elif kind == EVENT_GC:
+            duration, collected, uncollectable = items
+            if GC_LANE not in self.threadnames:
+                self.threadnames[GC_LANE] = "GC"
+                self.add_thread(GC_LANE, "GC")
+            self.add_gc(duration * micros, collected, uncollectable)
+        elif kind == EVENT_CPU:
+            self.add_counter("cpu", {"process": items[0], "system": items[1]})
+        elif kind == EVENT_MEMORY:
+            self.add_counter("memory", {"rss": items[0]})
+        elif kind in (EVENT_ANNOTATE, EVENT_ENTER, EVENT_EXIT):
+            prefix = {EVENT_ENTER: "Enter ", EVENT_EXIT: "Exit "}.get(kind, "")
+            self.add_annotation(prefix + items[0])
+        elif kind == EVENT_LANE:
+            self.lane, = items
+        elif kind == EVENT_THREAD_NAME:
+            lane, name = items
+            self.threadnames[lane] = name
+            self.add_thread(lane, name)
+        elif kind == EVENT_CLOCK:
+            self.micros = 1000000 / items[0]
+        elif kind == EVENT_TIMESTAMP:
+            self.add_timestamp()
+            self.first_when = self.first_when or items[0]
+            self.when = (items[0] - self.first_when) * micros
+            self.duration = max(self.duration, self.when)
+            self.lane = 0
+
+    def add_process(self):
+        pass
+
+    def add_thread(self, lane, name):
+        pass
+
+    def add_timestamp(self):
+        pass
+
+    def add_calls(self, callsite, count):
+        pass
+
+    def add_span(self, callsite, duration, cpu, codename, task):
+        pass
+
+    def add_wait(self, duration, name):
+        pass
+
+    def add_gc(self, duration, collected, uncollectable):
+        pass
+
+    def add_counter(self, name, values):
+        pass
+
+    def add_annotation(self, message):
+        pass
+
+
+class ChromeExporter(Exporter):
+    """Writes every record as a Chrome Trace Event as soon as it is read."""
+
+    def __init__(self, fout):
+        super().__init__()
+        self.fout = fout
+        self.separator = "[\n"
+        self.calls = {}
+
+    def write(self, event):
+        self.fout.write(self.separator + json.dumps(event))
+        self.separator = ",\n"
+
+    def finish(self):
+        self.fout.write(self.separator if self.separator == "[\n" else "\n")
+        self.fout.write("]\n")
+
+    def add_process(self):
+        self.write({"ph": "M", "name": "process_name", "pid": self.process, "tid": 0, "args": {"name": self.label}})
+
+    def add_thread(self, lane, name):
+        self.write({"ph": "M", "name": "thread_name", "pid": self.process, "tid": lane, "args": {"name": name}})
+
+    def add_timestamp(self):
+        # calls are counted per called module for every timestamp
+        if self.calls:
+            self.add_counter("calls", self.calls)
+            self.calls = {}
+
+    def add_calls(self, callsite, count):
+        callsite = self.get_callsite(callsite)
+        if callsite:
+            self.calls[callsite[1]] = self.calls.get(callsite[1], 0) + count
+
+    def add_complete(self, name, category, start, duration, args, lane=None):
+        lane = self.lane if lane is None else lane
+        self.write({"ph": "X", "name": name, "cat": category, "pid": self.process, "tid": lane,
+            "ts": round(start, 3), "dur": round(duration, 3), "args": args})
+
+    def add_span(self, callsite, duration, cpu, codename, task):
+        callsite = self.get_callsite(callsite)
+        if callsite:
+            args = {"source": callsite[0], "target": callsite[1]}
+            if task:
+                args.update(task=task, cpu_ms=round(cpu / 1000, 3))
+            self.add_complete(codename, callsite[1], self.when - duration, duration, args)
+
+    def add_wait(self, duration, name):
+        self.add_complete(f"blocked in {name}", "blocked", self.when - duration, duration, {})
+
+    def add_gc(self, duration, collected, uncollectable):
+        self.add_complete("GC", "gc", self.when - duration, duration, {"collected": collected, "uncollectable": uncollectable}, GC_LANE)
+
+    def add_counter(self, name, values):
+        self.write({"ph": "C", "name": name, "pid": self.process, "ts": round(self.when, 3), "args": values})
+
+    def add_annotation(self, message):
+        self.write({"ph": "i", "s": "p", "name": message, "pid": self.process, "tid": self.lane, "ts": round(self.when, 3)})
+
+
+class StackExporter(Exporter):
+    """Sums the number and time of spans, waits, and GC pauses, and the number of calls, per stack and thread."""
+
+    def __init__(self):
+        super().__init__()
+        self.times = {}
+        self.calls = {}
+
+    def get_thread(self, lane=None):
+        name = self.get_thread_name(lane)
+        return name if self.process == 1 else f"{self.label}: {name}"
+
+    def add_time(self, stack, duration, lane=None):
+        key = self.get_thread(lane), stack
+        count, total = self.times.get(key, (0, 0))
+        self.times[key] = count + 1, total + duration
+
+    def add_calls(self, callsite, count):
+        callsite = self.get_callsite(callsite)
+        if callsite:
+            key = self.get_thread(), callsite
+            self.calls[key] = self.calls.get(key, 0) + count
+
+    def add_span(self, callsite, duration, cpu, codename, task):
+        callsite = self.get_callsite(callsite)
+        if callsite:
+            self.add_time(callsite + (f"{callsite[1]}.{codename}",), duration)
+
+    def add_wait(self, duration, name):
+        self.add_time(("[blocked]", name), duration)
+
+    def add_gc(self, duration, collected, uncollectable):
+        self.add_time(("[gc]",), duration, GC_LANE)
+
+
+class SpeedscopeExporter(StackExporter):
+    """Writes one sampled profile of the time per thread, weighted in milliseconds, and one of the calls."""
+
+    def finish(self, fout, name):
+        frames, frame_indexes = [], {}
+
+        def get_frames(stack):
+            for frame in stack:
+                if frame not in frame_indexes:
+                    frame_indexes[frame] = len(frames)
+                    frames.append({"name": frame})
+            return [frame_indexes[frame] for frame in stack]
+
+        profiles = []
+        for thread in sorted(set(thread for thread, _ in self.times)):
+            stacks = [(stack, duration) for (owner, stack), (_, duration) in self.times.items() if owner == thread]
+            profiles.append(self.get_profile(thread, "milliseconds", [get_frames(stack) for stack, _ in stacks],
+                [round(duration / 1000, 3) for _, duration in stacks]))
+        if self.calls:
+            stacks = list(self.calls.items())
+            profiles.append(self.get_profile("Calls", "none", [get_frames((thread,) + stack) for (thread, stack), _ in stacks],
+                [count for _, count in stacks]))
+        json.dump({
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": name,
+            "exporter": "pynsights",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }, fout)
+
+    def get_profile(self, name, unit, samples, weights):
+        return {
+            "type": "sampled",
+            "name": name,
+            "unit": unit,
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }
+
+
+class PprofExporter(StackExporter):
+    """Writes a gzipped pprof profile with the calls, spans, and wall time of every stack, labeled by thread."""
+
+    def finish(self, fout):
+        strings, string_indexes = [], {}
+        functions, located = bytearray(), set()
+
+        def get_string(value):
+            if value not in string_indexes:
+                string_indexes[value] = len(strings)
+                strings.append(value)
+            return string_indexes[value]
+
+        def get_location(frame):
+            # every frame is a function with a location of the same id
+            index = get_string(frame)
+            if index not in located:
+                located.add(index)
+                write_field(functions, 5, encode_fields([(1, index), (2, index), (3, index)]))
+                write_field(functions, 4, encode_fields([(1, index), (4, encode_fields([(1, index)]))]))
+            return index
+
+        get_string("")
+        sample_types = [get_string(name) for name in ("calls", "spans", "wall", "count", "nanoseconds")]
+        profile = bytearray()
+        for name, unit in [(0, 3), (1, 3), (2, 4)]:
+            write_field(profile, 1, encode_fields([(1, sample_types[name]), (2, sample_types[unit])]))
+        thread_key = get_string("thread")
+        samples = {}
+        for (thread, stack), count in self.calls.items():
+            samples.setdefault((thread, stack), [0, 0, 0])[0] += count
+        for (thread, stack), (count, duration) in self.times.items():
+            values = samples.setdefault((thread, stack), [0, 0, 0])
+            values[1] += count
+            values[2] += round(duration * 1000)
+        for (thread, stack), values in samples.items():
+            # pprof lists the leaf first
+            locations = [get_location(frame) for frame in reversed(stack)]
+            label = encode_fields([(1, thread_key), (2, get_string(thread))])
+            write_field(profile, 2, encode_fields([(1, encode_packed(locations)), (2, encode_packed(values)), (3, label)]))
+        profile += functions
+        for value in strings:
+            write_field(profile, 6, value.encode("utf8"))
+        write_field(profile, 10, round(self.duration * 1000))
+        write_field(profile, 11, encode_fields([(1, sample_types[2]), (2, sample_types[4])]))
+        write_field(profile, 14, sample_types[2])
+        fout.write(gzip.compress(bytes(profile)))
+
+
+def write_field(data, field, value):
+    # protobuf fields are either a varint or length-delimited bytes
+    if isinstance(value, int):
+        write_varint(data, field << 3)
+        write_varint(data, value)
+    else:
+        write_varint(data, field << 3 | 2)
+        write_varint(data, len(value))
+        data += value
+
+
+def encode_fields(fields):
+    data = bytearray()
+    for field, value in fields:
+        write_field(data, field, value)
+    return bytes(data)
+
+
+def encode_packed(values):
+    data = bytearray()
+    for value in values:
+        write_varint(data, value)
+    return bytes(data)
+
+
+def read_traces(exporter, input_file):
+    with open(input_file, "rb") as fp:
+        exporter.read(read_events(fp), 1, input_file.name)
+    read_shards(input_file, exporter.first_when, lambda pid, events, first_when: exporter.read(events, pid, f"pid{pid}", first_when))
+
+
+def export(input_file, output=None, format="chrome"):
+    """Convert the trace and the traces of its child processes in one pass, and return the output path."""
+    if format not in EXPORT_FORMATS:
+        raise ValueError("unknown export format %s, use one of %s" % (format, ", ".join(EXPORT_FORMATS)))
+    output = output or input_file.with_suffix(EXPORT_SUFFIXES[format])
+    print(f"Exporting {input_file} to {output}", file=sys.stderr)
+    if format == "chrome":
+        with open(output, "w") as fout:
+            exporter = ChromeExporter(fout)
+            read_traces(exporter, input_file)
+            exporter.finish()
+    elif format == "speedscope":
+        exporter = SpeedscopeExporter()
+        read_traces(exporter, input_file)
+        with open(output, "w") as fout:
+            exporter.finish(fout, input_file.name)
+    else:
+        exporter = PprofExporter()
+        read_traces(exporter, input_file)
+        with open(output, "wb") as fout:
+            exporter.finish(fout)
+    return output
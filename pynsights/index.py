@@ -0,0 +1,117 @@
+"""
+Build and use a sidecar index that allows seeking into a trace.
+
+The index holds checkpoints that map a timestamp to the byte offset of the
+TIMESTAMP event that starts it, together with the number of modules,
+callsites, types, and lane names that were defined before that offset.
+"""
+
+import json
+import os
+
+from pynsights.constants import *
+from pynsights.tracefile import detect_format, is_compressed, read_events, read_events_at, read_header
+
+INDEX_VERSION = 3
+CHECKPOINT_INTERVAL = 1000 # milliseconds of trace time
+CHECKPOINT_BYTES = 1 << 20
+LATE_EVENTS = 1000 # milliseconds, the recorder writes slow calls up to one flush after later timestamps
+
+
+def get_index_filename(input_file):
+    return "%s.index" % input_file
+
+
+def build_index(input_file):
+    """Scan the trace once and write its index next to it."""
+    with open(input_file, "rb") as fp:
+        if is_compressed(fp.peek(1)):
+            raise ValueError("%s is compressed and cannot be seeked into, convert it with --compress none first" % input_file)
+        format = detect_format(fp)
+        fields = read_header(fp)[0] if format == "binary" else EVENT_FIELDS
+        fp.seek(0)
+        modules, callsites, types, threadnames, checkpoints = [], [], [], [], []
+        first_when = timestamp = 0
+        clock = CLOCK_MILLISECONDS
+        last_when = last_offset = None
+        for offset, kind, values in read_events(fp, offsets=True):
+            if kind == EVENT_TIMESTAMP:
+                when = values[0]
+                first_when = first_when or when
+                if last_when is None or (when - last_when) * CLOCK_MILLISECONDS >= CHECKPOINT_INTERVAL * clock or offset - last_offset >= CHECKPOINT_BYTES:
+                    checkpoints.append([round((when - first_when) * CLOCK_MILLISECONDS / clock), offset, timestamp, len(modules), len(callsites), len(types), len(threadnames)])
+                    last_when, last_offset = when, offset
+                timestamp = when
+            elif kind == EVENT_MODULE:
+                modules.append(values[0])
+            elif kind == EVENT_CALLSITE:
+                callsites.append(list(values))
+            elif kind == EVENT_TYPE:
+                types.append(values[0])
+            elif kind == EVENT_THREAD_NAME:
+                threadnames.append(list(values))
+            elif kind == EVENT_CLOCK:
+                clock = values[0]
+    index = {
+        "version": INDEX_VERSION,
+        "format": format,
+        "fields": {str(kind): field for kind, field in fields.items()},
+        "size": os.path.getsize(input_file),
+        "first_when": first_when,
+        "clock": clock,
+        "modules": modules,
+        "callsites": callsites,
+        "types": types,
+        "threadnames": threadnames,
+        "checkpoints": checkpoints,
+    }
+    with open(get_index_filename(input_file), "w") as fout:
+        json.dump(index, fout)
+    return index
+
+
+def load_index(input_file):
+    """Return the index of the trace, or None when it is missing or stale."""
+    filename = get_index_filename(input_file)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fp:
+        index = json.load(fp)
+    if index["version"] != INDEX_VERSION or index["size"] != os.path.getsize(input_file):
+        return None
+    index["fields"] = {int(kind): field for kind, field in index["fields"].items()}
+    return index
+
+
+def find_checkpoint(index, when):
+    """Return the last checkpoint at or before when, in milliseconds since the start of the trace."""
+    found = index["checkpoints"][0]
+    for checkpoint in index["checkpoints"]:
+        if checkpoint[0] > when:
+            break
+        found = checkpoint
+    return found
+
+
+def read_checkpoint(fp, index, checkpoint, end=None):
+    _, offset, timestamp, _, _, _, _ = checkpoint
+    return read_events_at(fp, index["format"], index["fields"], offset, timestamp, end)
+
+
+def select_window(events, first_when, start=None, end=None, clock=CLOCK_MILLISECONDS):
+    """Drop events outside [start, end], in milliseconds since the start of the trace, but keep definitions."""
+    when = 0
+    for kind, values in events:
+        if kind == EVENT_CLOCK:
+            clock = values[0]
+        if kind == EVENT_TIMESTAMP:
+            first_when = first_when or values[0]
+            when = (values[0] - first_when) * CLOCK_MILLISECONDS / clock
+            if end is not None and when > end + LATE_EVENTS:
+                return
+            if end is None or when <= end:
+                yield kind, values
+        elif kind in (EVENT_MODULE, EVENT_CALLSITE, EVENT_TYPE, EVENT_CLOCK, EVENT_THREAD_NAME):
+            yield kind, values
+        elif (start is None or when >= start) and (end is None or when <= end):
+            yield kind, values
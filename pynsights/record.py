@@ -3,24 +3,31 @@ Record inter-module calls and save events in a file
 """
 
 import atexit
+import dis
 import inspect
 import functools
 import gc
+import heapq
 import json
 import os
 import pathlib
 import re
+import signal
+import site
 import sys
 import threading
 import time
+import random
+import tracemalloc
+import weakref
 import psutil
-from pympler import muppy
-from pympler import summary
 
 from .constants import *
+from .tracefile import check_compression, compress_frame, find_shards, get_encoder
 
 
 process = psutil.Process(os.getpid())
+cpu_count = psutil.cpu_count() or 1
 
 
 def get_module(argv):
@@ -45,32 +52,159 @@ caller_module = os.path.basename(caller_module.replace(".py", ""))
 
 output_filename = "%s/pynsights_trace_%s.txt" % (os.path.expanduser('~'), caller_module)
 output = None
+trace_format = "text"
+compression = "none"
+encoder = None
 filename_index = {}
+code_index = {}
+call_stacks = threading.local()
 callsite_index = {}
+module_roots = {}
+package_dirs = {}
 type_index = {}
-lock = threading.Lock()
-buffer = []
+lock = threading.RLock()
+buffers = []
+thread_buffer = threading.local()
+definitions = []
+dropped_events = 0
+MAX_BUFFERED_EVENTS = 100000
+call_counts = []
+CALL_BUCKET_INTERVAL = 0.5
+call_bucket = CALL_BUCKET_INTERVAL
+bucket_start = 0
 call_count = 0
-start = time.time()
-last_flush = 0
+start = time.perf_counter_ns()
+CLOCK_TICKS = 1000000 # microseconds
 FLUSH_INTERVAL = 1.0
 METRICS_INTERVAL = 0.5
 HEAP_TIMER = 20
+HEAP_BUDGET = 0.05
+HEAP_SAMPLE_RATE = 0.01
+heap_backend = "gc"
+heap_budget = HEAP_BUDGET
+heap_offset = 0
+started_tracemalloc = False
 group_module_map = {}
 last_heap_snapshot = None
-heap_timer = 1
+last_switches = None
+last_io = None
+gil_delay = 0
+OVERHEAD_INTERVAL = 1.0
+last_overhead = 0
+hook_time = 0.0
+flush_time = 0.0
+heap_time = 0.0
+metrics_time = 0.0
+events_written = 0
+bytes_written = 0
+total_dropped = 0
 tracing = False
 metrics_monitor = None
+writer = None
+flush_requested = threading.Event()
+recorder_threads = set()
 gc_start = 0
 last_when = 0
 HOTSPOT_CALL_DURATION = 100
+span_threshold = HOTSPOT_CALL_DURATION
+span_ticks = HOTSPOT_CALL_DURATION * CLOCK_TICKS // 1000
+TOP_SPANS = 10
+top_spans = TOP_SPANS
+HISTOGRAM_BUCKETS = 32
+latency_stats = []
+backend = "setprofile"
+MODES = ["trace", "sample"]
+mode = "trace"
+SAMPLE_HZ = 100
+sample_hz = SAMPLE_HZ
+sampler = None
+monitored_before = False
+CHILD_SETTINGS = "PYNSIGHTS_CHILD"
+child_environment = {}
+follow_children = False
+trace_root = None
+verbose = True
+asyncio_mode = False
+async_frames = {}
+CO_ASYNC = inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+YIELD_VALUE = dis.opmap["YIELD_VALUE"]
+YIELD_FROM = dis.opmap.get("YIELD_FROM") # Python 3.10 and older
+RESUME = dis.opmap.get("RESUME") # Python 3.11 and newer
+lanes = {}
+lane_names = []
+last_lane = 0
+shared_events = []
+detect_blocking = False
+blocking_codes = {}
+waits = threading.local()
+BLOCKED_DURATION = 1
+BLOCKING_FUNCTIONS = {
+    "queue": ["Queue.get", "Queue.put"],
+    "threading": ["Condition.wait", "Event.wait", "Semaphore.acquire", "Barrier.wait", "Thread.join"],
+}
+LOCK_TYPES = {type(threading.Lock()): "Lock.acquire", type(threading.RLock()): "RLock.acquire"}
 
 def get_output():
     return output_filename
 
 
+def set_follow_children(enabled=True):
+    """Also record child processes, each into a shard next to the main trace."""
+    global follow_children
+    follow_children = enabled
+
+
+def set_asyncio_mode(enabled=True):
+    """Follow coroutines across awaits, so their spans show wall time and on-CPU time per task."""
+    global asyncio_mode
+    asyncio_mode = enabled
+
+
+def set_span_threshold(milliseconds, top=None):
+    """Keep calls that take longer than this as spans, at most top per callsite per flush."""
+    global span_threshold, span_ticks, top_spans
+    if milliseconds < 0 or top is not None and top < 0:
+        raise ValueError("the span threshold and the number of spans cannot be negative")
+    span_threshold = milliseconds
+    span_ticks = round(milliseconds * CLOCK_TICKS / 1000)
+    if top is not None:
+        top_spans = top
+
+
+def get_when():
+    # a monotonic clock, shared with child processes, that never jumps like time.time()
+    return (time.perf_counter_ns() - start) // 1000
+
+
+def set_detect_blocking(enabled=True):
+    """Record how long threads wait for locks, queues, conditions, and events."""
+    global detect_blocking
+    detect_blocking = enabled
+
+
+def get_shard_filename(filename, pid):
+    root, extension = os.path.splitext(filename)
+    return "%s.%d%s" % (root, pid, extension)
+
+
+def set_compression(name):
+    """Write the trace as "gzip" or "zlib" frames, one per flush, or uncompressed with "none"."""
+    global compression
+    check_compression(name)
+    compression = name
+
+
+def set_backend(name):
+    """Select "monitoring" (sys.monitoring, Python 3.12+) or "setprofile" to record calls."""
+    global backend
+    if name == "monitoring" and not hasattr(sys, "monitoring"):
+        raise ValueError("the monitoring backend requires Python 3.12 or newer")
+    if name not in ("monitoring", "setprofile"):
+        raise ValueError("unknown backend '%s'" % name)
+    backend = name
+
+
 def getcpu():
-    cpu_count = psutil.cpu_count()
     return process.cpu_percent() / cpu_count, psutil.cpu_percent()
 
 
@@ -79,30 +213,71 @@ class SkipCall(Exception):
 
 
 def get_type_index(typename):
-    if not typename in type_index:
-        record(0, "%s %s\n" % (
-            EVENT_TYPE,
-            typename
-        ))
-        type_index[typename] = len(type_index)
-    return type_index[typename]
+    index = type_index.get(typename)
+    if index is None:
+        with lock:
+            index = type_index.get(typename)
+            if index is None:
+                record(0, EVENT_TYPE, typename)
+                index = type_index[typename] = len(type_index)
+    return index
+
+
+def index_module_roots():
+    # map every import root to the prefix used in module names, so most
+    # filenames resolve with a few dict lookups instead of disk access
+    roots = list(sys.path) + site.getsitepackages() + [site.getusersitepackages()]
+    module_roots.clear()
+    for root in roots:
+        root = os.path.abspath(root or os.getcwd())
+        name = pathlib.Path(root).stem
+        module_roots[root] = "" if name == "site-packages" else re.sub("python[0-9.]*", "python", name)
+
+
+def get_module_from_roots(filename):
+    if not module_roots:
+        index_module_roots()
+    directory, name = os.path.split(os.path.abspath(filename))
+    parts = [os.path.splitext(name)[0]]
+    while True:
+        if directory in module_roots:
+            if parts[-1] == "__init__":
+                parts.pop()
+            prefix = module_roots[directory]
+            return ".".join(([prefix] if prefix else []) + parts)
+        parent, name = os.path.split(directory)
+        if parent == directory:
+            return None
+        parts.insert(0, name)
+        directory = parent
+
+
+def is_package(path):
+    if not path in package_dirs:
+        package_dirs[path] = os.path.exists(os.path.join(path, "__init__.py"))
+    return package_dirs[path]
 
 
 def get_module_from_filename(filename):
     # cannot use inspect.getmodule(frame) due to performance
-    parts = []
-    path = pathlib.Path(filename)
-    while path:
-        name = path.stem
+    if filename.startswith("<"):
+        name = pathlib.Path(filename).stem
         if name == "<string>":
             return "python.string"
         if name.startswith("<frozen "):
             name = re.sub("<frozen ", "", name).replace(">", "")
             return f"python.{name}"
+    module = get_module_from_roots(filename)
+    if module:
+        return module
+    parts = []
+    path = pathlib.Path(filename)
+    while path:
+        name = path.stem
         if name != "__init__":
             parts.insert(0, name)
         path = path.parent
-        if not os.path.exists(os.path.join(path, "__init__.py")): # not a module
+        if not is_package(path): # not a module
             break
     rootName = path.name or pathlib.Path(os.getcwd()).name
     if rootName != "site-packages":
@@ -110,26 +285,43 @@ def get_module_from_filename(filename):
     return ".".join(parts)
     
 
+def get_filename_index(filename):
+    # Two threads can meet the same new module at once. The lock makes sure only one
+    # defines it, and that its definition is recorded before anyone can use its index.
+    index = filename_index.get(filename)
+    if index is None:
+        with lock:
+            index = filename_index.get(filename)
+            if index is None:
+                mod = get_module_from_filename(filename)
+                if mod == "__main__":
+                    mod = pathlib.Path(filename).stem
+                record(0, EVENT_MODULE, mod)
+                index = filename_index[filename] = len(filename_index)
+    return index
+
+
 def get_module_index(frame):
-    filename = frame.f_code.co_filename
-    if not filename in filename_index:
-        mod = get_module_from_filename(filename)
-        if mod == "__main__":
-            mod = pathlib.Path(filename).stem
-        record(0, f"{EVENT_MODULE} {mod}\n")
-        filename_index[filename] = len(filename_index)
-    return filename_index[filename]
+    code = frame.f_code
+    # Keyed by id, so lambdas, exec code, and reloaded modules are not kept alive.
+    # The entry goes when its code does, through a callback that runs no Python code to trace.
+    entry = code_index.get(id(code))
+    if entry is None:
+        key = id(code)
+        entry = code_index[key] = get_filename_index(code.co_filename), weakref.ref(code, functools.partial(code_index.pop, key))
+    return entry[0]
 
 
 def get_callsite_index(source, target):
-    callsite = "%s>%s" % (source, target)
-    if not callsite in callsite_index:
-        record(0, "%s %s %s\n" % (
-            EVENT_CALLSITE,
-            source,
-            target))
-        callsite_index[callsite] = len(callsite_index)
-    return callsite_index[callsite]
+    key = source << 32 | target
+    index = callsite_index.get(key)
+    if index is None:
+        with lock:
+            index = callsite_index.get(key)
+            if index is None:
+                record(0, EVENT_CALLSITE, source, target)
+                index = callsite_index[key] = len(callsite_index)
+    return index
 
 
 def extract_call(frame):
@@ -140,43 +332,397 @@ def extract_call(frame):
     return source, target
 
 
+def get_buffer():
+    try:
+        return thread_buffer.events
+    except AttributeError:
+        events = thread_buffer.events = []
+        with lock:
+            buffers.append((threading.current_thread(), events, get_lane()))
+        return events
+
+
+def new_lane(ident):
+    with lock:
+        lane = lanes[ident] = len(lane_names)
+        lane_names.append(None)
+    return lane
+
+
+def get_lane():
+    # a small number per thread, so events only carry it when the thread changes
+    try:
+        return thread_buffer.lane
+    except AttributeError:
+        lane = None if threading.get_ident() in recorder_threads else new_lane(threading.get_ident())
+        thread_buffer.lane = lane
+        return lane
+
+
+def name_lanes(threads):
+    # Threads get their name when they start and can be renamed later. A thread
+    # that records before threading knows about it shows up as a dummy at first.
+    names = {lanes.get(thread.ident): thread.name for thread in threading.enumerate()}
+    for thread, lane in threads:
+        if lane is not None and lane_names[lane] is None:
+            names.setdefault(lane, thread.name)
+    for lane, name in names.items():
+        if lane is not None and lane_names[lane] != name:
+            lane_names[lane] = name
+            record(0, EVENT_THREAD_NAME, lane, name)
+
+
+def get_call_counts():
+    try:
+        return thread_buffer.counts
+    except AttributeError:
+        counts = thread_buffer.counts = {}
+        with lock:
+            call_counts.append((threading.current_thread(), counts, {}, get_lane()))
+        return counts
+
+
+def get_latency_stats():
+    try:
+        return thread_buffer.latency
+    except AttributeError:
+        stats = thread_buffer.latency = {}, {}
+        with lock:
+            latency_stats.append((threading.current_thread(), stats, {}, get_lane()))
+        return stats
+
+
+def collect_call_bucket(events, when):
+    # Threads only ever increment their own counts. The writer takes a copy and
+    # emits what changed since the previous bucket, so no increment is lost.
+    # A bucket is stamped when it ends, so it never goes before what was written already.
+    global bucket_start
+    if tracing and when - bucket_start < call_bucket * CLOCK_TICKS:
+        return
+    for thread, counts, reported, lane in list(call_counts):
+        bucket = {}
+        current = dict(counts)
+        for callsite, count in current.items():
+            delta = count - reported.get(callsite, 0)
+            if delta:
+                bucket[callsite] = delta
+        reported.update(current)
+        if not thread.is_alive():
+            call_counts.remove((thread, counts, reported, lane))
+        if bucket:
+            pairs = [value for pair in sorted(bucket.items()) for value in pair]
+            events.append((when, EVENT_BUCKET, (pairs,), lane))
+    bucket_start = when
+
+
+def collect_latencies(events, when):
+    # the same approach as the call buckets, for the histograms and the slowest calls
+    for thread, (latencies, slowest), reported, lane in list(latency_stats):
+        for callsite in list(slowest):
+            for duration, ended, codename in slowest.pop(callsite):
+                events.append((ended, EVENT_RETURN, (callsite, duration, codename), lane))
+        for callsite, stats in list(latencies.items()):
+            current = list(stats)
+            previous = reported.get(callsite)
+            delta = [now - before for now, before in zip(current, previous)] if previous else current
+            if delta[0]:
+                histogram = [value for bucket, count in enumerate(delta[2:]) if count for value in (bucket, count)]
+                events.append((when, EVENT_LATENCY, (callsite, delta[0], delta[1], histogram), lane))
+                reported[callsite] = current
+        if not thread.is_alive():
+            latency_stats.remove((thread, (latencies, slowest), reported, lane))
+
+
+def drain(events):
+    # appends from other threads are safe: they land after the count we take
+    count = len(events)
+    drained = events[:count]
+    del events[:count]
+    return drained
+
+
 def flush():
-    global buffer
-    lines, buffer = buffer, []
-    for line in lines:
-        output.write(line)
-    output.flush()
+    global last_when, last_lane, dropped_events, total_dropped, flush_time, events_written, bytes_written
+    begin = time.perf_counter()
+    events = []
+    # taken before the buffers are drained, so what threads record meanwhile is not stamped earlier
+    now = get_when()
+    with lock:
+        # named before the threads that ended are dropped below
+        name_lanes([(thread, lane) for thread, _, lane in buffers] + [(thread, lane) for thread, _, _, lane in call_counts + latency_stats])
+        # everything is drained before it is tagged, so the stamps in this flush stay close together
+        events.extend(drain(shared_events))
+        drained = []
+        for thread, buffer, lane in list(buffers):
+            if not buffer and not thread.is_alive():
+                buffers.remove((thread, buffer, lane))
+            drained.append((lane, drain(buffer)))
+        for lane, buffer in drained:
+            events.extend((when, kind, values, lane) for when, kind, values in buffer)
+        collect_call_bucket(events, now)
+        collect_latencies(events, now)
+    # drained after the events, so every module, callsite, and thread they use is included
+    batch = drain(definitions)
+    events.sort(key=lambda event: (event[0], event[3] or 0))
+    for when, kind, values, lane in events:
+        if when != last_when:
+            batch.append((EVENT_TIMESTAMP, (when,)))
+            last_when, last_lane = when, 0
+        # a timestamp switches back to the first lane, so readers can start at any timestamp
+        if lane is not None and lane != last_lane:
+            batch.append((EVENT_LANE, (lane,)))
+            last_lane = lane
+        batch.append((kind, values))
+    if dropped_events:
+        dropped, dropped_events = dropped_events, 0
+        total_dropped += dropped
+        batch.append((EVENT_DROPPED, (dropped,)))
+    record_overhead(batch)
+    if batch:
+        data = compress_frame(encoder.encode(batch), compression)
+        output.write(data)
+        output.flush()
+        events_written += len(batch)
+        bytes_written += len(data)
+    flush_time += time.perf_counter() - begin
+
+
+def record_overhead(batch):
+    # cumulative totals, so a reader can take the difference between any two
+    global last_overhead, last_when, last_lane
+    when = get_when()
+    if tracing and when - last_overhead < OVERHEAD_INTERVAL * CLOCK_TICKS:
+        return
+    last_overhead = when
+    # events recorded while this flush ran come later with earlier stamps, so use the last one written
+    when = last_when or when
+    if when != last_when:
+        batch.append((EVENT_TIMESTAMP, (when,)))
+        last_when, last_lane = when, 0
+    batch.append((EVENT_OVERHEAD, (
+        round(hook_time * 1e6),
+        round(flush_time * 1e6),
+        round(heap_time * 1e6),
+        round(metrics_time * 1e6),
+        events_written,
+        bytes_written,
+        total_dropped,
+    )))
+
+
+def record(when, kind, *values):
+    global dropped_events
+    if not when:
+        definitions.append((kind, values))
+        return
+    events = get_buffer()
+    if len(events) >= MAX_BUFFERED_EVENTS:
+        dropped_events += 1
+        flush_requested.set()
+        return
+    events.append((when, kind, values))
+
+
+def ignore_current_thread():
+    # threading may install the profile hook on a thread that starts while
+    # tracing is being switched on, so always take it off the recorder's own threads
+    recorder_threads.add(threading.get_ident())
+    sys.setprofile(None)
 
 
-def record(when, line):
-    global last_when
-    if when and when != last_when:
-        buffer.append("%s %s\n" % (EVENT_TIMESTAMP, when))
-    buffer.append(line)
-    last_when = when
+def write_events():
+    ignore_current_thread()
+    while tracing:
+        flush_requested.wait(min(FLUSH_INTERVAL, call_bucket or FLUSH_INTERVAL))
+        flush_requested.clear()
+        flush()
 
 
-def process_call(frame, event, _):
-    global call_count, last_flush
-    if event in ["c_call", "c_return"]:
+def get_call_stack():
+    try:
+        return call_stacks.calls
+    except AttributeError:
+        call_stacks.calls = []
+        return call_stacks.calls
+
+
+def pop_call(frame, when):
+    # Returns when the call into frame started. Entries above it belong to
+    # frames whose return we never saw, for instance when tracing was toggled.
+    stack = get_call_stack()
+    for n in range(len(stack) - 1, -1, -1):
+        if stack[n][0] is frame:
+            when = stack[n][1]
+            del stack[n:]
+            break
+    return when
+
+
+def count_call(callsite, when):
+    global call_count
+    if call_bucket:
+        counts = get_call_counts()
+        counts[callsite] = counts.get(callsite, 0) + 1
+    else:
+        record(when, EVENT_CALL, callsite)
+    call_count += 1
+
+
+def handle_call(frame, resumed=None):
+    if frame.f_code in blocking_codes:
+        start_wait(frame)
+    if asyncio_mode and frame.f_code.co_flags & CO_ASYNC:
+        return handle_async_call(frame, resumed)
+    source, target = extract_call(frame)
+    callsite = get_callsite_index(source, target)
+    when = get_when()
+    get_call_stack().append((frame, when))
+    count_call(callsite, when)
+
+
+def handle_return(frame, suspended=None):
+    if frame.f_code in blocking_codes:
+        end_wait(frame, blocking_codes[frame.f_code])
+    if asyncio_mode and frame.f_code.co_flags & CO_ASYNC:
+        return handle_async_return(frame, suspended)
+    source, target = extract_call(frame)
+    callsite = get_callsite_index(source, target)
+    when = get_when()
+    add_latency(callsite, when, when - pop_call(frame, when), frame.f_code.co_name)
+
+
+def add_latency(callsite, when, duration, codename):
+    # every return counts in the histogram of its callsite, and only the slowest
+    # few above the span threshold are kept, to be written as spans at the next flush
+    latencies, slowest = get_latency_stats()
+    stats = latencies.get(callsite)
+    if stats is None:
+        stats = latencies[callsite] = [0] * (2 + HISTOGRAM_BUCKETS)
+    stats[0] += 1
+    stats[1] += duration
+    stats[2 + min(duration.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+    if duration > span_ticks and top_spans:
+        heap = slowest.get(callsite)
+        if heap is None:
+            heap = slowest[callsite] = []
+        if len(heap) < top_spans:
+            heapq.heappush(heap, (duration, when, codename))
+        elif duration > heap[0][0]:
+            heapq.heapreplace(heap, (duration, when, codename))
+
+
+def start_wait(key):
+    # only the outermost wait counts, Queue.get waits in Condition.wait, which waits in Lock.acquire
+    if getattr(waits, "current", None) is None:
+        waits.current = key, get_when()
+
+
+def end_wait(key, name):
+    current = getattr(waits, "current", None)
+    if current and current[0] is key:
+        waits.current = None
+        when = get_when()
+        duration = when - current[1]
+        if duration >= BLOCKED_DURATION * CLOCK_TICKS // 1000:
+            record(when, EVENT_BLOCKED, duration, name)
+
+
+def get_lock_name(function):
+    if getattr(function, "__name__", None) == "acquire":
+        return LOCK_TYPES.get(type(getattr(function, "__self__", None)))
+
+
+def handle_c_call(event, function):
+    # setprofile reports lock.acquire() as a C call, a with statement never shows up
+    name = get_lock_name(function)
+    if name:
+        if event == "c_call":
+            start_wait(function)
+        else:
+            end_wait(function, name)
+
+
+def index_blocking_codes():
+    import queue
+    for module in (queue, threading):
+        for name in BLOCKING_FUNCTIONS[module.__name__]:
+            cls, method = name.split(".")
+            blocking_codes[getattr(getattr(module, cls), method).__code__] = name
+
+
+def is_resumed(frame):
+    # a coroutine starts at RESUME 0 and continues after an await at RESUME 1 or higher
+    if RESUME is None:
+        return frame.f_lasti >= 0
+    return frame.f_code.co_code[frame.f_lasti + 1] != 0
+
+
+def is_suspended(frame):
+    # setprofile reports a suspension as a return, at the yield or the RESUME after it
+    code, offset = frame.f_code.co_code, frame.f_lasti
+    if code[offset] == YIELD_VALUE:
+        return True
+    if RESUME is None:
+        return code[offset + 2:offset + 3] == bytes([YIELD_FROM])
+    return code[offset] == RESUME and code[offset + 1] != 0
+
+
+def get_task_name():
+    asyncio = sys.modules.get("asyncio")
+    try:
+        task = asyncio and asyncio.current_task()
+    except RuntimeError:
+        return "" # no running event loop in this thread
+    return task.get_name() if task else ""
+
+
+def handle_async_call(frame, resumed):
+    # A resumed coroutine is not a new call, it only runs another slice on the event
+    # loop. Its caller is the loop by now, so keep the callsite of the original call.
+    now = get_when()
+    if resumed is None:
+        resumed = is_resumed(frame)
+    if resumed:
+        state = async_frames.get(id(frame))
+        if not state:
+            raise SkipCall("started before tracing or a self call")
+        state[2] = now
         return
+    source, target = extract_call(frame)
+    callsite = get_callsite_index(source, target)
+    async_frames[id(frame)] = [now, 0, now, callsite]
+    count_call(callsite, now)
+
+
+def handle_async_return(frame, suspended):
+    now = get_when()
+    state = async_frames.get(id(frame))
+    if not state:
+        raise SkipCall("started before tracing or a self call")
+    state[1] += now - state[2]
+    if suspended is None:
+        suspended = is_suspended(frame)
+    if suspended:
+        return
+    del async_frames[id(frame)]
+    started, cpu, _, callsite = state
+    wall = now - started
+    if wall > span_ticks or cpu > span_ticks:
+        record(now, EVENT_ASYNC_RETURN, callsite, wall, cpu, frame.f_code.co_name, get_task_name())
+
+
+def process_call(frame, event, arg):
+    global hook_time
+    if event.startswith("c_") and not detect_blocking:
+        return
+    begin = time.perf_counter()
     try:
-        source, target = extract_call(frame)
-        callsite = get_callsite_index(source, target)
-        now = time.time()
-        when = round((now - start) * 1000)
         if event == "call":
-            frame.f_locals["__pynsights__when__"] = when
-            record(when, "%s %s\n" % (EVENT_CALL, callsite))
-            call_count += 1
-            if now - last_flush > FLUSH_INTERVAL:
-                flush()
-                last_flush = now
+            handle_call(frame)
         elif event == "return":
-            duration = when - frame.f_locals.get("__pynsights__when__", when)
-            if duration > HOTSPOT_CALL_DURATION:
-                record(when, "%s %s %s %s\n" % (EVENT_RETURN, callsite, duration, frame.f_code.co_name))
-
+            handle_return(frame)
+        else:
+            handle_c_call(event, arg)
     except AttributeError:
         pass # happens for bootstrap calls only
     except SkipCall:
@@ -185,43 +731,289 @@ def process_call(frame, event, _):
         import traceback
         traceback.print_exc()
     finally:
+        hook_time += time.perf_counter() - begin
         return process_call
 
 
+def monitor_event(code, handler):
+    # DISABLE would switch a code object off for every caller, including ones in
+    # other modules that come later, so calls within a module are filtered here
+    global hook_time
+    if threading.get_ident() in recorder_threads:
+        return None # setprofile never sees the recorder's own threads either
+    begin = time.perf_counter()
+    try:
+        handler(sys._getframe(2))
+    except AttributeError:
+        pass # happens for bootstrap calls only
+    except SkipCall:
+        pass # not an interesting call
+    except:
+        import traceback
+        traceback.print_exc()
+    finally:
+        hook_time += time.perf_counter() - begin
+
+
+def monitor_call(code, offset, *_):
+    return monitor_event(code, handle_call)
+
+
+def monitor_resume(code, offset, *_):
+    return monitor_event(code, resume_call)
+
+
+def monitor_return(code, offset, *_):
+    return monitor_event(code, finish_call)
+
+
+def monitor_yield(code, offset, *_):
+    return monitor_event(code, suspend_call)
+
+
+def monitor_unwind(code, offset, exception):
+    monitor_event(code, finish_call)
+
+
+def resume_call(frame):
+    handle_call(frame, resumed=True)
+
+
+def finish_call(frame):
+    handle_return(frame, suspended=False)
+
+
+def suspend_call(frame):
+    handle_return(frame, suspended=True)
+
+
+def monitor_c_call(code, offset, function, arg0):
+    # lock.acquire() is called as the method of the lock type, with the lock as
+    # its first argument. Any other call site is switched off after its first call.
+    for lock_type, name in LOCK_TYPES.items():
+        if function is lock_type.acquire:
+            if threading.get_ident() not in recorder_threads:
+                start_wait(function)
+            return None
+    return sys.monitoring.DISABLE
+
+
+def monitor_c_return(code, offset, function, arg0):
+    for lock_type, name in LOCK_TYPES.items():
+        if function is lock_type.acquire:
+            end_wait(function, name)
+
+
+BLOCKING_CALLBACKS = {
+    "CALL": monitor_c_call,
+    "C_RETURN": monitor_c_return,
+    "C_RAISE": monitor_c_return,
+}
+
+
+MONITORING_CALLBACKS = {
+    "PY_START": monitor_call,
+    "PY_RESUME": monitor_resume,
+    "PY_THROW": monitor_resume,
+    "PY_RETURN": monitor_return,
+    "PY_YIELD": monitor_yield,
+    "PY_UNWIND": monitor_unwind,
+}
+
+
+def start_monitoring():
+    global monitored_before
+    monitoring = sys.monitoring
+    if monitored_before:
+        # events that an earlier session returned DISABLE for stay off in the interpreter
+        monitoring.restart_events()
+    monitored_before = True
+    monitoring.use_tool_id(monitoring.PROFILER_ID, "pynsights")
+    events = 0
+    callbacks = dict(MONITORING_CALLBACKS, **(BLOCKING_CALLBACKS if detect_blocking else {}))
+    for name, callback in callbacks.items():
+        event = getattr(monitoring.events, name)
+        monitoring.register_callback(monitoring.PROFILER_ID, event, callback)
+        events |= event
+    monitoring.set_events(monitoring.PROFILER_ID, events)
+
+
+def stop_monitoring():
+    monitoring = sys.monitoring
+    if monitoring.get_tool(monitoring.PROFILER_ID) != "pynsights":
+        return
+    monitoring.set_events(monitoring.PROFILER_ID, 0)
+    for name in list(MONITORING_CALLBACKS) + list(BLOCKING_CALLBACKS):
+        monitoring.register_callback(monitoring.PROFILER_ID, getattr(monitoring.events, name), None)
+    monitoring.free_tool_id(monitoring.PROFILER_ID)
+
+
 def measure_gc(phase, info):
     global gc_start
-    when = round((time.time() - start) * 1000)
+    when = get_when()
     if phase == "start":
         gc_start = when
     elif phase == "stop":
         duration = when - gc_start
-        record(when, "%s %d %d %d\n" % (EVENT_GC, duration, info["collected"], info["uncollectable"]))
+        # a collection stops all threads, and can run in a thread that is still starting
+        shared_events.append((when, EVENT_GC, (duration, info["collected"], info["uncollectable"]), None))
 
 
 def measure_cpu(when):
     my_cpu, system_cpu = getcpu()
-    record(when, "%s %.1f %.1f\n" % (EVENT_CPU, my_cpu, system_cpu))
+    record(when, EVENT_CPU, round(my_cpu, 1), round(system_cpu, 1))
 
 
 def measure_memory(when):
-    process = psutil.Process(os.getpid())
     memory = process.memory_info().rss
-    record(when, "%s %.1f\n" % (EVENT_MEMORY, memory))
+    record(when, EVENT_MEMORY, float(memory))
 
 
-def measure_heap(when, force=False):
-    global heap_timer
-    heap_timer -= 1
-    if not force and heap_timer:
-        return
-    heap_timer = HEAP_TIMER
+def measure_threads(when):
+    global last_switches
+    switches = process.num_ctx_switches()
+    record(when, EVENT_THREADS, process.num_threads())
+    if last_switches:
+        record(when, EVENT_SWITCHES,
+            switches.voluntary - last_switches.voluntary,
+            switches.involuntary - last_switches.involuntary)
+    last_switches = switches
+
+
+def measure_io(when):
+    global last_io
+    try:
+        io = process.io_counters()
+    except (AttributeError, psutil.Error):
+        io = None # not available on macOS
+    if io and last_io:
+        record(when, EVENT_IO,
+            io.read_count - last_io.read_count,
+            io.write_count - last_io.write_count,
+            io.read_bytes - last_io.read_bytes,
+            io.write_bytes - last_io.write_bytes)
+    last_io = io
+    fds = process.num_fds() if hasattr(process, "num_fds") else process.num_handles()
+    record(when, EVENT_FDS, fds)
+
+
+def measure_pressure(when):
+    # gil_delay is how much later than asked the metrics thread woke up, which
+    # grows when it has to wait for the GIL or for a CPU
+    load = os.getloadavg()[0] / cpu_count if hasattr(os, "getloadavg") else 0.0
+    record(when, EVENT_PRESSURE, round(gil_delay * 1000, 2), round(load, 2))
+
+
+def measure_heap(when):
+    global heap_time
+    begin = time.perf_counter()
     record_heap(when)
+    heap_time += time.perf_counter() - begin
+
+
+def get_typename(obj):
+    kind = type(obj)
+    if kind.__module__ == "builtins":
+        return kind.__qualname__
+    return "%s.%s" % (kind.__module__, kind.__qualname__)
+
+
+def count_objects(objects, totals, deadline, start=0, step=1):
+    # Counts objects[start::step] until the deadline passes, then returns how many were seen.
+    seen = 0
+    for n in range(start, len(objects), step):
+        obj = objects[n]
+        typename = get_typename(obj)
+        count, size = totals.get(typename, (0, 0))
+        totals[typename] = count + 1, size + sys.getsizeof(obj)
+        seen += 1
+        if seen % 1000 == 0 and time.perf_counter() > deadline:
+            break
+    return seen
+
+
+def scale(totals, factor):
+    return [
+        (typename, round(count * factor), round(size * factor))
+        for typename, (count, size) in totals.items()
+    ]
+
+
+def summarize_muppy(deadline):
+    # walks every object, the deadline cannot be honored
+    from pympler import muppy
+    from pympler import summary
+    return summary.summarize(muppy.get_objects())
+
+
+def summarize_gc(deadline):
+    # the young generations are small and counted in full, the oldest one is
+    # counted until the deadline, from a rotating start, and extrapolated
+    global heap_offset
+    snapshot = []
+    for generation in range(2):
+        totals = {}
+        count_objects(gc.get_objects(generation), totals, float("inf"))
+        snapshot += scale(totals, 1)
+    objects = gc.get_objects(2)
+    if objects:
+        totals = {}
+        heap_offset %= len(objects)
+        seen = count_objects(objects[heap_offset:] + objects[:heap_offset], totals, deadline)
+        heap_offset += seen
+        snapshot += scale(totals, len(objects) / seen)
+    return merge_snapshot(snapshot)
+
+
+def summarize_sample(deadline):
+    objects = gc.get_objects()
+    step = max(1, round(1 / HEAP_SAMPLE_RATE))
+    totals = {}
+    seen = count_objects(objects, totals, deadline, random.randrange(step), step)
+    return scale(totals, len(objects) / max(1, seen))
+
+
+def summarize_tracemalloc(deadline):
+    # sizes are allocated bytes per module, counts are allocated blocks
+    totals = {}
+    if not tracemalloc.is_tracing():
+        return []
+    for statistic in tracemalloc.take_snapshot().statistics("filename"):
+        module = get_module_from_filename(statistic.traceback[0].filename)
+        count, size = totals.get(module, (0, 0))
+        totals[module] = count + statistic.count, size + statistic.size
+    return scale(totals, 1)
+
+
+def merge_snapshot(snapshot):
+    totals = {}
+    for typename, count, size in snapshot:
+        total_count, total_size = totals.get(typename, (0, 0))
+        totals[typename] = total_count + count, total_size + size
+    return scale(totals, 1)
+
+
+HEAP_BACKENDS = {
+    "gc": summarize_gc,
+    "sample": summarize_sample,
+    "tracemalloc": summarize_tracemalloc,
+    "muppy": summarize_muppy,
+}
+
+
+def set_heap_backend(name, budget=None):
+    """Select how heap snapshots are taken, see HEAP_BACKENDS, and the seconds each may take."""
+    global heap_backend, heap_budget
+    if name not in HEAP_BACKENDS:
+        raise ValueError("unknown heap backend '%s', use one of %s" % (name, ", ".join(HEAP_BACKENDS)))
+    heap_backend = name
+    if budget is not None:
+        heap_budget = budget
 
 
 def record_heap(when):
     global last_heap_snapshot
-    objects = muppy.get_objects()
-    heap_snapshot = summary.summarize(objects)
+    heap_snapshot = HEAP_BACKENDS[heap_backend](time.perf_counter() + heap_budget)
     totalSize = 0
     totalCount = 0
     for _, count, size in heap_snapshot:
@@ -235,62 +1027,363 @@ def record_heap(when):
         ] + [
             [ get_type_index("Total#Heap#Size#and#Count"), totalCount, totalSize ]
         ]
-        record(when, "%s %s\n" % (EVENT_HEAP, json.dumps(dump)))
+        # a snapshot can outlast a flush, so it is stamped when done, not behind what was written meanwhile
+        record(max(when, get_when()), EVENT_HEAP, json.dumps(dump))
     last_heap_snapshot = heap_snapshot
 
 
+METRICS = {
+    "memory": measure_memory,
+    "cpu": measure_cpu,
+    "threads": measure_threads,
+    "io": measure_io,
+    "pressure": measure_pressure,
+}
+metric_intervals = {
+    "memory": METRICS_INTERVAL,
+    "cpu": METRICS_INTERVAL,
+    "threads": 1.0,
+    "io": 1.0,
+    "pressure": 1.0,
+    "heap": HEAP_TIMER * METRICS_INTERVAL,
+}
+
+
+def set_metric_interval(name, seconds):
+    """Measure the given metric, see metric_intervals, every this many seconds, or never when 0."""
+    if name not in metric_intervals:
+        raise ValueError("unknown metric '%s', use one of %s" % (name, ", ".join(metric_intervals)))
+    if seconds < 0:
+        raise ValueError("the %s interval cannot be negative" % name)
+    metric_intervals[name] = seconds
+
+
 def generate_metrics():
+    global gil_delay, metrics_time
+    ignore_current_thread()
+    due = dict.fromkeys(metric_intervals, 0)
     while tracing:
-        when = round((time.time() - start) * 1000)
-        measure_memory(when)
-        measure_cpu(when)
-        measure_heap(when)
-        time.sleep(METRICS_INTERVAL)
+        begin = time.perf_counter()
+        now = time.time()
+        when = get_when()
+        with process.oneshot():
+            for name, measure in METRICS.items():
+                if metric_intervals[name] and now >= due[name]:
+                    measure(when)
+                    due[name] = now + metric_intervals[name]
+        metrics_time += time.perf_counter() - begin
+        if metric_intervals["heap"] and now >= due["heap"]:
+            measure_heap(when)
+            due["heap"] = now + metric_intervals["heap"]
+        interval = min([seconds for seconds in metric_intervals.values() if seconds] or [METRICS_INTERVAL])
+        before = time.perf_counter()
+        time.sleep(interval)
+        gil_delay = max(0, time.perf_counter() - before - interval)
 
 
 def start_metrics_monitor():
     global metrics_monitor
-    if not metrics_monitor:
-        metrics_monitor = threading.Thread(target=generate_metrics)
+    if metrics_monitor and metrics_monitor.is_alive():
+        return # the monitor of a previous session is still sleeping and carries on
+    metrics_monitor = threading.Thread(target=generate_metrics, daemon=True)
     metrics_monitor.start()
 
 
+def sample_stacks(active):
+    # A cross-module frame that shows up for the first time counts as a call,
+    # and one that is gone since the last sample has returned.
+    when = get_when()
+    seen = {}
+    counts = {}
+    for ident, frame in sys._current_frames().items():
+        if ident in recorder_threads:
+            continue
+        lane = lanes.get(ident)
+        if lane is None:
+            lane = new_lane(ident)
+            name_lanes([])
+        while frame.f_back:
+            if frame in active:
+                seen[frame] = active.pop(frame)
+            else:
+                try:
+                    callsite = get_callsite_index(*extract_call(frame))
+                except SkipCall:
+                    pass
+                else:
+                    seen[frame] = callsite, when, lane
+                    counts[callsite, lane] = counts.get((callsite, lane), 0) + 1
+            frame = frame.f_back
+    # the sampler records for other threads, so it adds the lane of each event itself
+    for frame, (callsite, started, lane) in active.items():
+        duration = when - started
+        if duration > span_ticks:
+            shared_events.append((when, EVENT_RETURN, (callsite, duration, frame.f_code.co_name), lane))
+    for (callsite, lane), count in counts.items():
+        shared_events.append((when, EVENT_CALLS, (callsite, count), lane))
+    return seen, sum(counts.values())
+
+
+def generate_samples():
+    global call_count, hook_time
+    ignore_current_thread()
+    active = {}
+    interval = 1.0 / sample_hz
+    while tracing:
+        begin = time.perf_counter()
+        active, count = sample_stacks(active)
+        call_count += count
+        elapsed = time.perf_counter() - begin
+        hook_time += elapsed
+        time.sleep(max(0, interval - elapsed))
+
+
+def start_sampler():
+    global sampler
+    sampler = threading.Thread(target=generate_samples, daemon=True)
+    sampler.start()
+
+
+def set_call_bucket(seconds):
+    """Count calls per callsite for this many seconds before writing them, or write every call when 0."""
+    global call_bucket
+    if seconds < 0:
+        raise ValueError("the call bucket interval cannot be negative")
+    call_bucket = seconds
+
+
+def set_mode(name, hz=None):
+    """Select "trace" to record every call or "sample" to sample all stacks hz times per second."""
+    global mode, sample_hz
+    if name not in MODES:
+        raise ValueError("unknown mode '%s', use one of %s" % (name, ", ".join(MODES)))
+    mode = name
+    sample_hz = hz or SAMPLE_HZ
+
+
+def start_writer():
+    global writer
+    writer = threading.Thread(target=write_events, daemon=True)
+    writer.start()
+
+
+def export_child_settings():
+    # spawned interpreters start from scratch, so they find the settings in their
+    # environment and the bootstrap sitecustomize on their path
+    if not child_environment:
+        child_environment.update((name, os.environ.get(name)) for name in [CHILD_SETTINGS, "PYTHONPATH"])
+    os.environ[CHILD_SETTINGS] = json.dumps({
+        "output": trace_root or output_filename,
+        "start": start,
+        "format": trace_format,
+        "compression": compression,
+        "backend": backend,
+        "mode": mode,
+        "sample_hz": sample_hz,
+        "call_bucket": call_bucket,
+        "heap": heap_backend,
+        "asyncio": asyncio_mode,
+        "blocking": detect_blocking,
+        "span_threshold": span_threshold,
+        "top_spans": top_spans,
+    })
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(package_dir, "bootstrap"), os.path.dirname(package_dir)]
+    current = os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    os.environ["PYTHONPATH"] = os.pathsep.join([path for path in paths if path not in current] + [path for path in current if path])
+
+
+def restore_child_settings():
+    # processes started after the recording stopped are not recorded
+    for name, value in child_environment.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    child_environment.clear()
+
+
+def start_child():
+    """Record this interpreter, spawned by a program that is recorded with follow_children."""
+    global start, trace_root, output_filename, trace_format, compression, backend, verbose
+    settings = json.loads(os.environ[CHILD_SETTINGS])
+    start = settings["start"]
+    trace_root = settings["output"]
+    output_filename = get_shard_filename(trace_root, os.getpid())
+    trace_format = settings["format"]
+    compression = settings["compression"]
+    if settings["backend"] == "monitoring" and hasattr(sys, "monitoring"):
+        backend = "monitoring"
+    else:
+        backend = "setprofile"
+    set_mode(settings["mode"], settings["sample_hz"])
+    set_call_bucket(settings["call_bucket"])
+    set_heap_backend(settings["heap"])
+    set_follow_children()
+    set_asyncio_mode(settings["asyncio"])
+    set_detect_blocking(settings["blocking"])
+    set_span_threshold(settings["span_threshold"], settings["top_spans"])
+    verbose = False
+    start_tracing()
+    stop_on_terminate()
+
+
+def stop_on_terminate():
+    # multiprocessing ends pool workers with SIGTERM, which skips atexit and its own
+    # finalizers, so write the shard first unless the program handles SIGTERM itself
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, terminate)
+    except ValueError:
+        pass # not the main thread
+
+
+def terminate(signum, frame):
+    stop_tracing()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def reset_session():
+    # a new trace file defines its modules, callsites, types, and lanes again
+    global thread_buffer, waits, last_lane, last_when
+    for index in [filename_index, code_index, callsite_index, type_index]:
+        index.clear()
+    del definitions[:], buffers[:], call_counts[:], shared_events[:], latency_stats[:]
+    async_frames.clear()
+    lanes.clear()
+    del lane_names[:]
+    waits = threading.local()
+    thread_buffer = threading.local()
+    last_lane = last_when = 0
+
+
+def reset_trace_state():
+    # what a forked child inherits from the parent's trace, which its own shard cannot use
+    global lock, flush_requested, process, writer, sampler, metrics_monitor
+    global call_count, dropped_events, total_dropped, last_when, last_overhead, last_switches, last_io, last_heap_snapshot
+    global hook_time, flush_time, heap_time, metrics_time, events_written, bytes_written
+    reset_session()
+    recorder_threads.clear()
+    lock = threading.RLock()
+    flush_requested = threading.Event()
+    process = psutil.Process(os.getpid())
+    writer = sampler = metrics_monitor = None
+    call_count = dropped_events = total_dropped = last_when = last_overhead = 0
+    last_switches = last_io = last_heap_snapshot = None
+    hook_time = flush_time = heap_time = metrics_time = 0.0
+    events_written = bytes_written = 0
+
+
+def restart_in_child():
+    # A forked child has a copy of the recorder without its threads, and shares the
+    # output file with the parent. Point that file at /dev/null, so the copy of its
+    # buffer never ends up in the parent's trace, then continue in a shard or stop.
+    global output, tracing, trace_root, output_filename, verbose
+    if not tracing:
+        return
+    tracing = False
+    if backend == "monitoring" and mode != "sample":
+        stop_monitoring()
+    else:
+        threading.setprofile(None)
+        sys.setprofile(None)
+    if measure_gc in gc.callbacks:
+        gc.callbacks.remove(measure_gc)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, output.fileno())
+    os.close(devnull)
+    output = None
+    reset_trace_state()
+    if follow_children:
+        trace_root = trace_root or output_filename
+        output_filename = get_shard_filename(trace_root, os.getpid())
+        verbose = False
+        start_tracing()
+        stop_on_terminate()
+        if "multiprocessing" in sys.modules:
+            # multiprocessing ends its children with os._exit, skipping atexit, and clears
+            # its finalizers after this hook ran, so add ours from its own after-fork hook
+            from multiprocessing import util
+            util.register_after_fork(restart_in_child, lambda _: util.Finalize(None, stop_tracing, exitpriority=0))
+
+
 def start_tracing():
-    global output, tracing
+    global output, tracing, encoder, bucket_start, started_tracemalloc
     if tracing: return
     tracing = True
-    output = open(output_filename, "w")
-    print("Pynsights: tracing started. See", output_filename)
+    if not trace_root:
+        # render merges every shard next to the trace, so those of an earlier run have to go
+        for _, shard in find_shards(output_filename):
+            os.remove(shard)
+    output = open(output_filename, "wb")
+    encoder = get_encoder(trace_format)
+    output.write(compress_frame(encoder.header(), compression))
+    record(0, EVENT_CLOCK, CLOCK_TICKS)
+    index_module_roots()
+    if detect_blocking:
+        index_blocking_codes()
+    get_lane()
+    bucket_start = get_when()
+    if verbose:
+        print("Pynsights: tracing started. See", output_filename)
+    if follow_children:
+        export_child_settings()
+    if heap_backend == "tracemalloc" and not tracemalloc.is_tracing():
+        # a program that traces allocations itself keeps doing so after the recording
+        tracemalloc.start()
+        started_tracemalloc = True
     start_metrics_monitor()
-    threading.setprofile(process_call)
-    sys.setprofile(process_call)
+    start_writer()
+    if mode == "sample":
+        start_sampler()
+    elif backend == "monitoring":
+        start_monitoring()
+    else:
+        threading.setprofile(process_call)
+        sys.setprofile(process_call)
     gc.callbacks.append(measure_gc)
 
 
 
 def flush_counters():
-    when = round((time.time() - start) * 1000)
+    when = get_when()
     measure_cpu(when)
     measure_memory(when)
-    measure_heap(when, True)
+    measure_heap(when)
 
 
 def stop_tracing():
-    global output, tracing
+    global output, tracing, started_tracemalloc
     tracing = False
-    threading.setprofile(None)
-    sys.setprofile(None)
+    if mode == "sample":
+        if sampler:
+            sampler.join()
+    elif backend == "monitoring":
+        stop_monitoring()
+    else:
+        threading.setprofile(None)
+        sys.setprofile(None)
     flush_counters()
-    if buffer and output:
+    restore_child_settings()
+    if started_tracemalloc:
+        tracemalloc.stop()
+        started_tracemalloc = False
+    if writer:
+        flush_requested.set()
+        writer.join()
+    if output:
         flush()
-        print("Pynsights: tracing finished. Traced %d calls. See" % call_count, output_filename)
+        output.close()
+        reset_session()
+        if verbose:
+            print("Pynsights: tracing finished. Traced %d calls. See" % call_count, output_filename)
         output = None
 
 
 def annotate(message, event=EVENT_ANNOTATE):
-    now = time.time()
-    when = round((now - start) * 1000)
-    record(when, "%s %s\n" % (event, message))
+    when = get_when()
+    record(when, event, str(message).replace("\n", " "))
 
 
 def annotate_enter(func):
@@ -315,11 +1408,34 @@ def trace(func):
     return tracefunc_closure
 
 class Recorder(object):
-    def __init__(self, file=None):
-        global output_filename
+    def __init__(self, file=None, backend=None, format=None, mode=None, sample_hz=None, call_bucket=None, heap=None, heap_budget=None, metric_intervals=None, compression=None, follow_children=False, asyncio=False, blocking=False, span_threshold=None, top_spans=None):
+        global output_filename, trace_format
         if file:
             output_filename = os.path.expanduser(file)
             print("Pynsights: recording to", output_filename)
+        if backend:
+            set_backend(backend)
+        if format:
+            get_encoder(format)
+            trace_format = format
+        if compression:
+            set_compression(compression)
+        if follow_children:
+            set_follow_children()
+        if asyncio:
+            set_asyncio_mode()
+        if blocking:
+            set_detect_blocking()
+        if span_threshold is not None or top_spans is not None:
+            set_span_threshold(span_threshold if span_threshold is not None else HOTSPOT_CALL_DURATION, top_spans)
+        if mode or sample_hz:
+            set_mode(mode or "sample", sample_hz)
+        if call_bucket is not None:
+            set_call_bucket(call_bucket)
+        if heap or heap_budget is not None:
+            set_heap_backend(heap or heap_backend, heap_budget)
+        for name, seconds in (metric_intervals or {}).items():
+            set_metric_interval(name, seconds)
 
     def __enter__(self):
         start_tracing()
@@ -329,4 +1445,6 @@ class Recorder(object):
 
 
 atexit.register(stop_tracing)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_in_child)
 
@@ -1,42 +1,150 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 import os
 import threading
+import time
 
+from . import record
 from .record import start_tracing
 from .record import stop_tracing
 from .record import get_output
+from .tracefile import Inflater, compress_frame, detect_format, is_compressed
 
 PORT_NUMBER = 9135
+FOLLOW_INTERVAL = 0.5
+CHUNK_SIZE = 1 << 16
+GZIP_MARKER = b"\x1f"
 web_server = None
 
 
 class RemoteServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
     def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/trace":
+            self.send_trace(int(query.get("since", ["0"])[0]))
+        elif url.path == "/follow":
+            self.follow_trace(int(query.get("since", ["0"])[0]))
+        else:
+            self.send_text("ok")
+            if url.path == "/start":
+                start_tracing()
+            elif url.path == "/stop":
+                stop_tracing()
+            elif url.path == "/exit":
+                os._exit(4)
+
+    def can_resume(self, path, since):
+        # only a plain text trace can be read from an offset, a binary trace needs its header
+        # and the previous timestamp, and a compressed one has to start at a frame
+        if since and os.path.exists(path):
+            with open(path, "rb") as fp:
+                if is_compressed(fp.peek(1)[:1]) or detect_format(fp) == "binary":
+                    self.send_error(400, "since only works for uncompressed text traces")
+                    return False
+        return True
+
+    def send_text(self, text):
+        body = bytes(text, "utf8")
+        self.send_response(200)
+        self.send_header('Content-type','text/pynsights')
+        self.send_header('Content-length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_transcoder(self, path):
+        # the Content-Encoding of the response and how to turn the bytes of the file into it
+        accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        with open(path, "rb") as fp:
+            first = fp.read(1)
+        if is_compressed(first):
+            if accepts_gzip and first == GZIP_MARKER:
+                return "gzip", None
+            return None, Inflater().feed
+        if accepts_gzip:
+            return "gzip", lambda data: compress_frame(data, "gzip")
+        return None, None
+
+    def send_chunk(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+    def send_trace(self, since):
+        # everything written after offset since, the client asks again with the returned offset
+        path = get_output()
+        print("Pynsights: Remote control opening", path, "at offset", since)
+        if not self.can_resume(path, since):
+            return
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        since = min(since, size)
+        encoding, transcode = self.get_transcoder(path) if size else (None, None)
         self.send_response(200)
         self.send_header('Content-type','text/pynsights')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if transcode:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-length', size - since)
+        self.send_header('X-Pynsights-Offset', size)
         self.end_headers()
-        if self.path == "/trace":
-            self.send_trace()
-        elif self.path == "/start":
-            start_tracing()
-        elif self.path == "/stop":
-            stop_tracing()
-        elif self.path == "/exit":
-            os._exit(4)
-
-    def send_trace(self):
+        if size > since:
+            with open(path, "rb") as fp:
+                fp.seek(since)
+                remaining = size - since
+                while remaining:
+                    data = fp.read(min(CHUNK_SIZE, remaining))
+                    remaining -= len(data)
+                    if transcode:
+                        self.send_chunk(transcode(data))
+                    else:
+                        self.wfile.write(data)
+        if transcode:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def follow_trace(self, since):
+        # a chunked response that keeps sending what the writer appends until it closes the output
         path = get_output()
-        print("Pynsights: Remote control opening", path)
-        if os.path.exists(path):
-            with open(path) as fp:
-                lines = fp.readlines()
-                for line in lines:
-                    self.wfile.write(bytes(line, 'utf8'))
+        print("Pynsights: Remote control following", path, "from offset", since)
+        if not self.can_resume(path, since):
+            return
+        while record.tracing and not (os.path.exists(path) and os.path.getsize(path)):
+            time.sleep(FOLLOW_INTERVAL)
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        encoding, transcode = self.get_transcoder(path) if exists else (None, None)
+        self.send_response(200)
+        self.send_header('Content-type','text/pynsights')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            if exists:
+                with open(path, "rb") as fp:
+                    fp.seek(since)
+                    while True:
+                        # stop_tracing writes the last frame after tracing is already off,
+                        # so only the end of the file after the output is closed is the end
+                        finished = not record.tracing and record.output is None
+                        data = fp.read(CHUNK_SIZE)
+                        if data:
+                            self.send_chunk(transcode(data) if transcode else data)
+                        elif finished:
+                            break
+                        else:
+                            time.sleep(FOLLOW_INTERVAL)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client went away
 
 
 def listen(portNumber = PORT_NUMBER):
     global web_server
-    web_server = HTTPServer(("localhost", portNumber), RemoteServer)
+    web_server = ThreadingHTTPServer(("localhost", portNumber), RemoteServer)
+    web_server.daemon_threads = True
     print("Pynsights: remote access server started http://localhost:%s/trace" % (portNumber))
     threading.Thread(target=run).start()
 
@@ -47,4 +155,4 @@ def run():
     except KeyboardInterrupt:
         pass
     web_server.server_close()
-    print("Pynsights remote access server stopped.")
\ No newline at end of file
+    print("Pynsights remote access server stopped.")
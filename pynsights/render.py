@@ -2,35 +2,36 @@
     Trace modules, classes, methods, and functions and send events to JavaScript client.
 """
 
+import array
+import base64
 import json
 import pathlib
+import re
+import sys
 import webbrowser
 import os
-import urllib
+import urllib.request
 import time
 from pynsights.constants import *
-
-modulenames = []
-typenames = []
-callsites = []
-calls = []
-total_calls = 0
-cpus = []
-heap = []
-gcs = []
-memories = []
-annotations = []
-spans = []
-first_when = 0
-last_call = {}
-when = 0
+from pynsights.index import find_checkpoint, load_index, read_checkpoint, select_window
+from pynsights.tracefile import StreamDecoder, find_shards, read_events, read_shards
 
 template_file = __file__.replace("render.py", "index.html")
 filler = " " * 40
 
+SUMMARY_RESOLUTIONS = [4096, 1024, 256]
+SYSTEM_METRICS = {EVENT_THREADS, EVENT_SWITCHES, EVENT_IO, EVENT_FDS, EVENT_PRESSURE}
 
-def show_progress(percent, end=""):
-    print(f"\r - {percent}% done - {total_calls:,} calls processed", filler, end=end)
+MODULES_TO_SKIP = {
+    "python.importlib",
+    "pynsights",
+    "pynsights.pynsights",
+    "pynsights.pynsights.cli",
+    "pynsights.pynsights.record",
+    "pynsights.record",
+    "python.runpy",
+    "python.zipimport",
+}
 
 
 def format_bytes(size):
@@ -45,140 +46,414 @@ def format_bytes(size):
     return f"{round(size)}{power_labels[n]}B"
 
 
-def read_dump(input_file):
+class TraceModel(object):
+    """
+    The state built from the events of one trace.
+
+    Feed it events from read_events(), which streams them from a file, socket,
+    stdin, or HTTP response. Memory grows with the aggregated calls and spans,
+    not with the number of events in the trace.
+    """
+
+    def __init__(self):
+        self.modulenames = []
+        self.typenames = []
+        self.callsites = []
+        self.calls = []
+        self.total_calls = 0
+        self.dropped_events = 0
+        self.cpus = []
+        self.heap = []
+        self.gcs = []
+        self.memories = []
+        self.system = []
+        self.overheads = []
+        self.annotations = []
+        self.spans = []
+        self.blocks = []
+        self.latencies = {}
+        self.threadnames = {}
+        self.lane = 0
+        self.first_when = 0
+        self.scale = 1
+        self.last_call = {}
+        self.when = 0
+
+    def seed(self, index, checkpoint):
+        """Start at a checkpoint of the index, with the modules, callsites, types, and lane names defined before it."""
+        when, _, _, module_count, callsite_count, type_count, threadname_count = checkpoint
+        self.modulenames = index["modules"][:module_count]
+        self.callsites = [tuple(callsite) for callsite in index["callsites"][:callsite_count]]
+        self.typenames = index["types"][:type_count]
+        self.threadnames = dict(index["threadnames"][:threadname_count])
+        self.first_when = index["first_when"]
+        self.scale = CLOCK_MILLISECONDS / index["clock"]
+        self.when = when
+
+    def merge(self, other):
+        """Append the state of a model that was fed the events that follow ours."""
+        for name in ["calls", "cpus", "heap", "gcs", "memories", "system", "overheads", "annotations", "spans", "blocks"]:
+            getattr(self, name).extend(getattr(other, name))
+        self.threadnames.update(other.threadnames)
+        for callsite, latency in other.latencies.items():
+            self.add_latency(callsite, latency)
+        for name in ["modulenames", "callsites", "typenames"]:
+            if len(getattr(other, name)) > len(getattr(self, name)):
+                setattr(self, name, getattr(other, name))
+        self.total_calls += other.total_calls
+        self.dropped_events += other.dropped_events
+        self.when = max(self.when, other.when)
+
+    def add_process(self, other, label):
+        """Add the model of a child process, with its modules renamed to label.module so each process is a group."""
+        modules, callsites = len(self.modulenames), len(self.callsites)
+        lanes = max(self.threadnames, default=0) + 1
+        self.modulenames.extend(f"{label}.{name}" for name in other.modulenames)
+        self.callsites.extend((source + modules, target + modules) for source, target in other.callsites)
+        self.threadnames.update((lane + lanes, f"{label}: {name}") for lane, name in other.threadnames.items())
+        self.calls.extend((when, callsite + callsites, count, lane + lanes) for when, callsite, count, lane in other.calls)
+        self.spans.extend([when, callsite + callsites, duration, codename, cpu, task, lane + lanes] for when, callsite, duration, codename, cpu, task, lane in other.spans)
+        self.blocks.extend([when, duration, name, lane + lanes] for when, duration, name, lane in other.blocks)
+        for callsite, latency in other.latencies.items():
+            self.add_latency(callsite + callsites, latency)
+        self.annotations.extend((when, f"{label}: {message}") for when, message in other.annotations)
+        self.gcs.extend(other.gcs)
+        for name in ["calls", "spans", "blocks", "annotations", "gcs"]:
+            getattr(self, name).sort(key=lambda item: item[0])
+        self.total_calls += other.total_calls
+        self.dropped_events += other.dropped_events
+        self.when = max(self.when, other.when)
+
+    def show_progress(self, percent, end=""):
+        print(f"\r - {percent}% done - {self.total_calls:,} calls processed", filler, end=end)
+
+    def feed(self, events, fp=None, size=0):
+        for n, (kind, values) in enumerate(events):
+            try:
+                self.handle_event(kind, values)
+            except Exception as e:
+                print(f"Error handling event: {kind} {values}: {e}")
+            if size and n % 100000 == 0:
+                self.show_progress(min(100, round(fp.tell() * 100 / size)))
+        self.show_progress(100)
+        self.flush_call_sites()
+
+    def flush_call_sites(self):
+        for (callsite, lane), (when, count) in self.last_call.items():
+            self.calls.append((when, callsite, count, lane))
+        self.last_call.clear()
+
+    def skip_module(self, moduleIndex):
+        if moduleIndex < len(self.modulenames):
+            return self.modulenames[moduleIndex] in MODULES_TO_SKIP
+
+    def skip_call(self, callsite):
+        if callsite < len(self.callsites):
+            source, target = self.callsites[callsite]
+            return self.skip_module(source) or self.skip_module(target)
+
+    def add_call(self, when, callsite, weight=1):
+        if self.skip_call(callsite):
+            return
+        self.total_calls += weight
+        count = 0
+        key = callsite, self.lane
+        if key in self.last_call:
+            lastWhen, count = self.last_call[key]
+            if when - lastWhen > 500:
+                self.calls.append((lastWhen, callsite, count, self.lane))
+        self.last_call[key] = when, count + weight
+
+    def add_bucket(self, when, pairs):
+        # the recorder already counted calls per callsite, so they go in as is
+        for n in range(0, len(pairs), 2):
+            callsite, count = pairs[n], pairs[n + 1]
+            if not self.skip_call(callsite):
+                self.total_calls += count
+                self.calls.append((when, callsite, count, self.lane))
+
+    def add_latency(self, callsite, latency):
+        count, total, histogram = self.latencies.get(callsite, (0, 0, {}))
+        for bucket, bucket_count in latency[2].items():
+            histogram[bucket] = histogram.get(bucket, 0) + bucket_count
+        self.latencies[callsite] = count + latency[0], total + latency[1], histogram
+
+    def get_latencies(self):
+        """Return the latency distribution of each module edge, keyed by "source target", in milliseconds."""
+        edges = {}
+        for callsite, (count, total, histogram) in self.latencies.items():
+            if callsite < len(self.callsites) and not self.skip_call(callsite):
+                key = " ".join(self.modulenames[module] for module in self.callsites[callsite])
+                edge = edges.setdefault(key, (0, 0, {}))
+                for bucket, bucket_count in histogram.items():
+                    edge[2][bucket] = edge[2].get(bucket, 0) + bucket_count
+                edges[key] = edge[0] + count, edge[1] + total, edge[2]
+        return {
+            key: {
+                "count": count,
+                "mean": round(total / count, 3),
+                **{f"p{percent}": get_percentile(histogram, count, percent) for percent in (50, 90, 99)},
+            }
+            for key, (count, total, histogram) in edges.items()
+        }
+
+    def handle_event(self, kind, items):
+        when = self.when
+        scale = self.scale
+        if kind == EVENT_MODULE:
+            module, = items
+            self.modulenames.append(module)
+        elif kind == EVENT_CPU:
+            cpu, cpu_system = items
+            self.cpus.append((when, cpu, cpu_system))
+        elif kind == EVENT_MEMORY:
+            memory, = items
+            self.memories.append((when, memory))
+        elif kind == EVENT_TYPE:
+            typename, = items
+            self.typenames.append(typename)
+        elif kind == EVENT_HEAP:
+            counts = json.loads(items[0])
+            self.heap.append((when, counts))
+        elif kind == EVENT_GC:
+            gc_duration, collected, uncollectable = items
+            self.gcs.append((when, gc_duration * scale, collected, uncollectable))
+        elif kind == EVENT_CALLSITE:
+            callsite = tuple(items)
+            self.callsites.append(callsite)
+        elif kind == EVENT_CALL:
+            callsite, = items
+            self.add_call(when, callsite)
+        elif kind == EVENT_BUCKET:
+            self.add_bucket(when, items[0])
+        elif kind == EVENT_CALLS:
+            callsite, count = items
+            self.add_call(when, callsite, count)
+        elif kind == EVENT_RETURN:
+            callsite, duration, codename = items
+            duration *= scale
+            if not self.skip_call(callsite):
+                self.spans.append([round(when - duration), callsite, duration, codename, duration, "", self.lane])
+            self.flush_call_sites()
+        elif kind == EVENT_ASYNC_RETURN:
+            # wall time includes the awaits, cpu time is how long the event loop was blocked
+            callsite, wall, cpu, codename, task = items
+            wall, cpu = wall * scale, cpu * scale
+            if not self.skip_call(callsite):
+                self.spans.append([round(when - wall), callsite, wall, codename, cpu, task, self.lane])
+            self.flush_call_sites()
+        elif kind == EVENT_BLOCKED:
+            duration, name = items
+            duration *= scale
+            self.blocks.append([round(when - duration), duration, name, self.lane])
+        elif kind == EVENT_LATENCY:
+            callsite, count, total, pairs = items
+            # bucket n counts the durations below 2**n ticks, keep its upper bound in milliseconds
+            histogram = {round((1 << pairs[n]) * scale, 3) if pairs[n] else 0: pairs[n + 1] for n in range(0, len(pairs), 2)}
+            self.add_latency(callsite, (count, total * scale, histogram))
+        elif kind == EVENT_CLOCK:
+            self.scale = CLOCK_MILLISECONDS / items[0]
+        elif kind == EVENT_LANE:
+            self.lane, = items
+        elif kind == EVENT_THREAD_NAME:
+            lane, name = items
+            self.threadnames[lane] = name
+        elif kind == EVENT_ANNOTATE:
+            message, = items
+            self.annotations.append((when, message))
+            self.flush_call_sites()
+        elif kind == EVENT_ENTER:
+            message, = items
+            self.annotations.append((when, f"Enter {message}"))
+            self.flush_call_sites()
+        elif kind == EVENT_EXIT:
+            message, = items
+            self.annotations.append((when, f"Exit {message}"))
+            self.flush_call_sites()
+        elif kind in SYSTEM_METRICS:
+            self.system.append([when, kind] + list(items))
+        elif kind == EVENT_OVERHEAD:
+            self.overheads.append([when] + list(items))
+        elif kind == EVENT_DROPPED:
+            self.dropped_events += items[0]
+        elif kind == EVENT_TIMESTAMP:
+            timestamp, = items
+            self.first_when = self.first_when or timestamp
+            self.when = round((timestamp - self.first_when) * scale)
+            self.lane = 0
+
+    def print_summary(self):
+        print(f"\r - Number of calls: {self.total_calls:,}", filler)
+        if self.dropped_events:
+            print(f" - Dropped events: {self.dropped_events:,}")
+        if self.overheads:
+            _, hook, flush, heap, metrics, events, written, dropped = self.overheads[-1]
+            print(f" - Recorder overhead: {(hook + flush + heap + metrics) / 1e6:.2f}s"
+                  f" (hooks {hook / 1e6:.2f}s, writing {flush / 1e6:.2f}s, heap {heap / 1e6:.2f}s, metrics {metrics / 1e6:.2f}s),"
+                  f" {events:,} events, {format_bytes(written)} written, {dropped:,} dropped")
+
+    def generate(self, output, refresh=None, diffs=None):
+        with open(template_file) as fin:
+            template = fin.read()
+        if refresh:
+            template = template.replace("<head>", f'<head>\n    <meta http-equiv="refresh" content="{refresh}">', 1)
+        print(f" - Program duration: {self.when/1000:.1f}s")
+        values = {
+            "DURATION": lambda: str(self.when),
+            "MODULENAMES": lambda: json.dumps(self.modulenames),
+            "CALLSITES": lambda: json.dumps(self.callsites),
+            "CALLS": lambda: json.dumps(encode_table(sorted(self.calls, key=lambda call: call[0]), "iiii")),
+            "CPUS": lambda: json.dumps(encode_table(self.cpus, "iff")),
+            "ANNOTATIONS": lambda: json.dumps(self.annotations, indent=4),
+            "SPANS": lambda: json.dumps(encode_table(sorted(self.spans, key=lambda span: span[0]), "iifsfsi")),
+            "BLOCKS": lambda: json.dumps(encode_table(sorted(self.blocks, key=lambda block: block[0]), "ifsi")),
+            "LATENCIES": lambda: json.dumps(self.get_latencies()),
+            "THREADNAMES": lambda: json.dumps([self.threadnames.get(lane, f"Thread {lane}") for lane in range(max(self.threadnames, default=-1) + 1)]),
+            "HEAP": lambda: "[\n    " + ",\n    ".join(json.dumps(snapshot) for snapshot in self.heap) + "\n]",
+            "GC": lambda: "[\n    " + ",\n    ".join(json.dumps(gc) for gc in self.gcs) + "\n]",
+            "TYPES": lambda: json.dumps(self.typenames),
+            "MEMORIES": lambda: json.dumps(encode_table(self.memories, "if")),
+            "SUMMARIES": lambda: json.dumps({
+                "cpus": [encode_table(rows, "iff") for rows in summarize_series(self.cpus)],
+                "memories": [encode_table(rows, "if") for rows in summarize_series(self.memories)],
+            }),
+            "SYSTEM": lambda: json.dumps(self.system),
+            "OVERHEAD": lambda: json.dumps(self.overheads),
+            "DIFF": lambda: json.dumps(diffs or {}),
+        }
+        with open(output, "w") as fout:
+            # the odd parts are placeholder names, written as the data followed by a comment that hides the default
+            for n, part in enumerate(re.split(r"/\*([A-Z]+)\*/", template)):
+                if n % 2 == 0:
+                    fout.write(part)
+                elif part in values:
+                    fout.write(values[part]() + " //")
+                else:
+                    fout.write(f"/*{part}*/")
+        print(" - Output file:", output, f"{format_bytes(os.path.getsize(output))}", filler)
+
+
+def get_percentile(histogram, count, percent):
+    # the histogram is keyed by the upper bound of each bucket, so this is an upper bound as well
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen * 100 >= count * percent:
+            return bucket
+    return 0
+
+
+def encode_column(values, type):
+    if type == "s":
+        return [type, list(values)]
+    data = array.array(type, values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return [type, base64.b64encode(data.tobytes()).decode("ascii")]
+
+
+def encode_table(rows, types):
+    """Encode rows as one base64 Int32Array ("i"), Float32Array ("f"), or string list ("s") per column."""
+    columns = list(zip(*rows)) or [[] for _ in types]
+    return {
+        "length": len(rows),
+        "columns": [encode_column(column, type) for column, type in zip(columns, types)],
+    }
+
+
+def downsample(rows, threshold):
+    """Keep threshold of the rows, chosen with Largest-Triangle-Three-Buckets on (when, value), so peaks survive."""
+    if threshold < 3 or len(rows) <= threshold:
+        return rows
+    sampled = [rows[0]]
+    every = (len(rows) - 2) / (threshold - 2)
+    previous = rows[0]
+    for bucket in range(threshold - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        following = rows[end:min(int((bucket + 2) * every) + 1, len(rows))] or rows[-1:]
+        average_when = sum(row[0] for row in following) / len(following)
+        average_value = sum(row[1] for row in following) / len(following)
+        when, value = previous[0], previous[1]
+        previous = max(rows[start:end], key=lambda row: abs(
+            (when - average_when) * (row[1] - value) - (when - row[0]) * (average_value - value)))
+        sampled.append(previous)
+    sampled.append(rows[-1])
+    return sampled
+
+
+def summarize_series(rows):
+    """Return the series at every resolution in SUMMARY_RESOLUTIONS that is smaller than the series itself."""
+    return [downsample(rows, threshold) for threshold in SUMMARY_RESOLUTIONS if threshold < len(rows)]
+
+
+def parse_time(text):
+    """Convert "150", "150s", "2.5m", "1h", or "500ms" into milliseconds."""
+    for suffix, factor in [("ms", 1), ("s", 1000), ("m", 60000), ("h", 3600000)]:
+        if text.endswith(suffix):
+            return round(float(text[:-len(suffix)]) * factor)
+    return round(float(text) * 1000)
+
+
+def read_dump(input_file, start=None, end=None):
+    model = TraceModel()
+    if str(input_file) == "-":
+        print("Loading trace from stdin")
+        model.feed(select_window(read_events(sys.stdin.buffer), 0, start, end))
+        model.print_summary()
+        return model
     print(f"Loading {input_file}")
-    print(f" - Dump size: {format_bytes(os.path.getsize(input_file))}")
-    with open(input_file) as fp:
-        parse_lines(fp.readlines())
-    print(f"\r - Number of calls: {total_calls:,}", filler)
-
-
-def parse_lines(lines):
-    done = 0
-    one_percent = round(len(lines) / 100)
-    for n, line in enumerate(lines):
-        try:
-            handle_line(line)
-        except Exception as e:
-            print(f"Error handling line: '{line}': {e}")
-        if not one_percent or n % one_percent == 0:
-            show_progress(done)
-            done += 1
-    show_progress(100)
-    flush_call_sites()
-
-
-def flush_call_sites():
-    for callsite in last_call:
-        when, count = last_call[callsite]
-        calls.append((when, callsite, count))
-    last_call.clear()
+    size = os.path.getsize(input_file)
+    print(f" - Dump size: {format_bytes(size)}")
+    index = load_index(input_file) if start is not None else None
+    with open(input_file, "rb") as fp:
+        if index and index["checkpoints"]:
+            checkpoint = find_checkpoint(index, start)
+            print(f" - Seeking to {checkpoint[0]/1000:.1f}s at byte {checkpoint[1]:,}")
+            model.seed(index, checkpoint)
+            events = read_checkpoint(fp, index, checkpoint)
+        else:
+            events = read_events(fp)
+        model.feed(select_window(events, model.first_when, start, end, CLOCK_MILLISECONDS / model.scale), fp, size)
+    model.print_summary()
+    return model
 
-MODULES_TO_SKIP = {
-    "python.importlib",
-    "pynsights",
-    "pynsights.pynsights",
-    "pynsights.pynsights.cli",
-    "pynsights.pynsights.record",
-    "pynsights.record",
-    "python.runpy",
-    "python.zipimport",
-}
 
-def skip_module(moduleIndex):
-    if moduleIndex < len(modulenames):
-        return modulenames[moduleIndex] in MODULES_TO_SKIP
-
-def skip_call(callsite):
-    if callsite < len(callsites):
-        source, target = callsites[callsite]
-        return skip_module(source) or skip_module(target)
-        
-def add_call(when, callsite):
-    global total_calls
-    if skip_call(callsite):
-        return
-    total_calls += 1
-    count = 0
-    if callsite in last_call:
-        lastWhen, count = last_call[callsite]
-        if when - lastWhen > 500:
-            calls.append((lastWhen, callsite, count))
-    last_call[callsite] = when, count + 1
-    source, target = callsites[callsite]
-
-def handle_line(line):
-    global first_when, when
-    if not line:
-        return
-    items = line.replace("\n", "").split()
-    kind = int(items[0])
-    if kind == EVENT_MODULE:
-        _, module = items
-        modulenames.append(module)
-    elif kind == EVENT_CPU:
-        cpu, cpu_system = float(items[1]), float(items[2])
-        cpus.append((when, cpu, cpu_system))
-    elif kind == EVENT_MEMORY:
-        memory = float(items[1])
-        memories.append((when, memory))
-    elif kind == EVENT_TYPE:
-        typename = items[1]
-        typenames.append(typename)
-    elif kind == EVENT_HEAP:
-        counts = json.loads(" ".join(items[1:]))
-        heap.append((when, counts))
-    elif kind == EVENT_GC:
-        gc_duration, collected, uncollectable = int(items[1]), int(items[2]), int(items[3])
-        gcs.append((when, gc_duration, collected, uncollectable))
-    elif kind == EVENT_CALLSITE:
-        callsite = int(items[1]), int(items[2])
-        callsites.append(callsite)
-    elif kind == EVENT_CALL:
-        callsite = int(items[1])
-        add_call(when, callsite)
-    elif kind == EVENT_RETURN:
-        callsite, duration, codename = int(items[1]), int(items[2]), items[3]
-        if not skip_call(callsite):
-            spans.append([when - duration, callsite, duration, codename])
-        flush_call_sites()
-    elif kind == EVENT_ANNOTATE:
-        message = " ".join(items[1:])
-        annotations.append((when, message))
-        flush_call_sites()
-    elif kind == EVENT_ENTER:
-        message = " ".join(items[1:])
-        annotations.append((when, f"Enter {message}"))
-        flush_call_sites()
-    elif kind == EVENT_EXIT:
-        message = " ".join(items[1:])
-        annotations.append((when, f"Exit {message}"))
-        flush_call_sites()
-    elif kind == EVENT_TIMESTAMP:
-        timestamp = int(items[1])
-        first_when = first_when or timestamp
-        when = timestamp - first_when
-
-
-def generate(output):
-    with open(template_file) as fin:
-        template = fin.read()
-    print(f" - Program duration: {(when - first_when)/1000:.1f}s")
-    html = template\
-        .replace("/*DURATION*/", str(when) + " //") \
-        .replace("/*MODULENAMES*/", json.dumps(modulenames) + " //") \
-        .replace("/*CALLSITES*/", json.dumps(callsites) + " //") \
-        .replace("/*CALLS*/", json.dumps(calls) + " //") \
-        .replace("/*CPUS*/", json.dumps(cpus) + " //") \
-        .replace("/*ANNOTATIONS*/", json.dumps(annotations, indent=4) + " //") \
-        .replace("/*SPANS*/", json.dumps(spans, indent=4) + " //") \
-        .replace("/*HEAP*/", "[\n    " + ",\n    ".join(json.dumps(snapshot) for snapshot in heap) + "\n] //") \
-        .replace("/*GC*/", "[\n    " + ",\n    ".join(json.dumps(gc) for gc in gcs) + "\n] //") \
-        .replace("/*TYPES*/", json.dumps(typenames) + " //") \
-        .replace("/*MEMORIES*/", json.dumps(memories, indent=4) + " //")
-    with open(output, "w") as fout:
-        fout.write(html)
-    print(" - Output file:", output, f"{format_bytes(os.path.getsize(output))}", filler)
+def read_children(model, input_file, start=None, end=None):
+    def read_child(pid, events, first_when):
+        print(f"Loading child process {pid}")
+        child = TraceModel()
+        child.first_when = first_when
+        child.feed(select_window(events, first_when, start, end))
+        model.add_process(child, f"pid{pid}")
+
+    read_shards(input_file, model.first_when, read_child)
+    model.print_summary()
+
+
+def read_chunk(input_file, index, first, last):
+    checkpoints = index["checkpoints"]
+    end = checkpoints[last][1] if last < len(checkpoints) else None
+    model = TraceModel()
+    model.seed(index, checkpoints[first])
+    with open(input_file, "rb") as fp:
+        model.feed(read_checkpoint(fp, index, checkpoints[first], end))
+    return model
+
+
+def read_dump_parallel(input_file, index, jobs):
+    from concurrent.futures import ProcessPoolExecutor
+    print(f"Loading {input_file} with {jobs} processes")
+    checkpoints = index["checkpoints"]
+    step = max(1, -(-len(checkpoints) // jobs))
+    bounds = [(first, first + step) for first in range(0, len(checkpoints), step)]
+    with ProcessPoolExecutor(jobs) as pool:
+        models = list(pool.map(read_chunk, *zip(*[(input_file, index, first, last) for first, last in bounds])))
+    model = models[0]
+    for other in models[1:]:
+        model.merge(other)
+    model.print_summary()
+    return model
 
 
 def open_ui(output):
@@ -186,23 +461,54 @@ def open_ui(output):
     webbrowser.open("file://" + str(output.resolve()))
 
 
-def render(input_file, output=None, open_browser=False):
+def render(input_file, output=None, open_browser=False, start_when=None, end_when=None, jobs=1):
     start = time.time()
-    read_dump(input_file)
+    index = load_index(input_file) if jobs > 1 and start_when is None and end_when is None else None
+    if index and index["checkpoints"]:
+        model = read_dump_parallel(input_file, index, jobs)
+    else:
+        model = read_dump(input_file, start_when, end_when)
+    if str(input_file) != "-" and find_shards(input_file):
+        read_children(model, input_file, start_when, end_when)
     if output is None:
-        output = input_file.with_suffix(".html")
+        output = "trace.html" if str(input_file) == "-" else input_file.with_suffix(".html")
     print(" - Processing time:", f"{time.time() - start:.1f}s", filler)
-    generate(output)
+    model.generate(output)
     if open_browser:
         open_ui(pathlib.Path(output))
 
 
 def render_remote(url, output, open_browser=False):
     start = time.time()
-    trace = urllib.request.urlopen(url).read()
-    print("Retrieved external trace dump:", len(trace), "bytes")
-    parse_lines(trace.decode('utf-8').split("\n"))
+    model = TraceModel()
+    with urllib.request.urlopen(urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})) as response:
+        print("Streaming external trace dump from", url)
+        model.feed(read_events(response))
+    model.print_summary()
     print(" - Processing time:", f"{time.time() - start:.1f}s", filler)
-    generate(output)
+    model.generate(output)
     if open_browser:
         open_ui(pathlib.Path(output))
+
+
+def follow_remote(url, output, open_browser=False, refresh=5):
+    """Render the trace of a remote program while it is being recorded, every refresh seconds."""
+    model = TraceModel()
+    decoder = StreamDecoder()
+    last_generate = 0
+    with urllib.request.urlopen(urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})) as response:
+        print("Following external trace from", url)
+        while True:
+            data = response.read1(65536)
+            for kind, values in decoder.feed(data):
+                model.handle_event(kind, values)
+            if not data or time.time() - last_generate > refresh:
+                model.flush_call_sites()
+                model.show_progress(100, end="\n")
+                model.generate(output, refresh if data else None)
+                if open_browser and not last_generate:
+                    open_ui(pathlib.Path(output))
+                last_generate = time.time()
+            if not data:
+                break
+    model.print_summary()
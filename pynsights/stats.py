@@ -0,0 +1,101 @@
+"""
+Summarize a trace in the terminal, without rendering it.
+
+The trace is read once into a TraceSummary, so this works on traces of any
+size, in CI jobs, and over ssh.
+"""
+
+import sys
+
+from pynsights.diff import HEAP_TOTAL, TraceSummary
+from pynsights.render import format_bytes
+from pynsights.tracefile import read_events
+
+
+def read_summary(input_file):
+    summary = TraceSummary()
+    if str(input_file) == "-":
+        for kind, values in read_events(sys.stdin.buffer):
+            summary.handle_event(kind, values)
+        return summary
+    with open(input_file, "rb") as fp:
+        for kind, values in read_events(fp):
+            summary.handle_event(kind, values)
+    return summary
+
+
+def get_stats(summary, limit=20):
+    """Return the totals of a summary as a dict that can be written as JSON, with the largest items of each kind first."""
+    modules = {}
+    for (source, target), count in summary.calls.items():
+        modules.setdefault(source, {"module": source, "calls_out": 0, "calls_in": 0, "fan_out": 0, "fan_in": 0})
+        modules.setdefault(target, {"module": target, "calls_out": 0, "calls_in": 0, "fan_out": 0, "fan_in": 0})
+        modules[source]["calls_out"] += count
+        modules[source]["fan_out"] += 1
+        modules[target]["calls_in"] += count
+        modules[target]["fan_in"] += 1
+    callsites = []
+    for (source, target), count in summary.calls.items():
+        returns, total = summary.latencies.get((source, target), (0, 0))
+        callsites.append(dict(source=source, target=target, calls=count,
+            mean=round(total / returns, 3) if returns else None))
+    hotspots = [
+        dict(source=source, target=target, function=function, count=count, total=round(total, 3), longest=round(longest, 3))
+        for (source, target, function), (count, total, longest) in summary.spans.items()
+    ]
+    heap = [
+        dict(type=typename, count=count, size=size)
+        for typename, (count, size) in summary.heap.items()
+        if typename != HEAP_TOTAL
+    ]
+    return {
+        "duration": summary.when,
+        "calls": summary.total_calls,
+        "gc": {
+            "count": summary.gc_count,
+            "pause": round(summary.gc_pause, 3),
+            "longest": round(summary.gc_max, 3),
+        },
+        "memory": summary.memory_peak,
+        "heap_total": summary.heap.get(HEAP_TOTAL, (0, 0))[1],
+        "callsites": sorted(callsites, key=lambda callsite: -callsite["calls"])[:limit],
+        "hotspots": sorted(hotspots, key=lambda hotspot: -hotspot["total"])[:limit],
+        "modules": sorted(modules.values(), key=lambda module: -module["fan_in"] - module["fan_out"])[:limit],
+        "heap": sorted(heap, key=lambda item: -item["size"])[:limit],
+    }
+
+
+def format_stats(stats):
+    """Return the stats as text."""
+    milliseconds = lambda value: f"{round(value, 1):,}ms"
+    gc = stats["gc"]
+    lines = [
+        f"Duration       {milliseconds(stats['duration'])}",
+        f"Calls          {stats['calls']:,}",
+        f"GC pauses      {gc['count']:,}, total {milliseconds(gc['pause'])}, longest {milliseconds(gc['longest'])}",
+        f"Peak memory    {format_bytes(round(stats['memory']))}",
+        f"Heap size      {format_bytes(stats['heap_total'])}",
+        "",
+        "Calls per callsite:",
+    ]
+    for callsite in stats["callsites"]:
+        mean = f", mean {callsite['mean']:,}ms" if callsite["mean"] is not None else ""
+        lines.append(f"  {callsite['calls']:,}  {callsite['source']} -> {callsite['target']}{mean}")
+    lines += ["", "Hotspots:"]
+    for hotspot in stats["hotspots"]:
+        lines.append(f"  {milliseconds(hotspot['total'])}  {hotspot['source']} -> {hotspot['target']} {hotspot['function']}:"
+                     f" {hotspot['count']:,} calls, longest {milliseconds(hotspot['longest'])}")
+    lines += ["", "Modules by fan-in and fan-out:"]
+    for module in stats["modules"]:
+        lines.append(f"  {module['module']}: called from {module['fan_in']} modules ({module['calls_in']:,} calls),"
+                     f" calls {module['fan_out']} modules ({module['calls_out']:,} calls)")
+    lines += ["", "Heap types:"]
+    for item in stats["heap"]:
+        lines.append(f"  {item['type']}: {format_bytes(item['size'])} in {item['count']:,} objects")
+    return "\n".join(lines)
+
+
+def stats(input_file, limit=20):
+    """Read the trace once and return its stats."""
+    print(f"Summarizing {input_file}", file=sys.stderr)
+    return get_stats(read_summary(input_file), limit)
@@ -0,0 +1,471 @@
+"""
+Read and write trace events in the text and binary trace formats.
+
+A text trace has one event per line, such as "2 17". A binary trace starts
+with a header holding a version and the fields of every event kind, followed
+by records made of a varint kind and the varint, float, or string fields.
+
+Either format can be compressed as a sequence of gzip or zlib frames. Every
+flush of the recorder writes one frame that decompresses on its own, so a
+crash loses at most the frame that was being written.
+"""
+
+import gzip
+import io
+import itertools
+import pathlib
+import re
+import struct
+import zlib
+
+from pynsights.constants import *
+
+FORMATS = ["text", "binary"]
+MAGIC = b"PYNSIGHTS"
+VERSION = 1
+CHUNK_SIZE = 1 << 20
+COMPRESSIONS = ["none", "gzip", "zlib"]
+COMPRESS_LEVEL = 6
+FRAME_MARKERS = (b"\x1f", b"\x78") # the first byte of a gzip or zlib frame
+FRAME_WBITS = 47 # accept both gzip and zlib headers
+
+double = struct.Struct("<d")
+# runs of one byte timestamp and call records, the bulk of a trace written with --call-bucket 0
+TIMESTAMP_CALLS = re.compile(b"(?:%s[\\x00-\\x7f]%s[\\x00-\\x7f])+" % (re.escape(bytes([EVENT_TIMESTAMP])), re.escape(bytes([EVENT_CALL]))))
+CALLS = re.compile(b"(?:%s[\\x00-\\x7f])+" % re.escape(bytes([EVENT_CALL])))
+
+
+class IncompleteRecord(Exception):
+    pass
+
+
+def format_value(value):
+    if isinstance(value, list):
+        return " ".join(str(item) for item in value)
+    return str(value)
+
+
+class TextEncoder(object):
+    def header(self):
+        return b""
+
+    def encode(self, events):
+        return "".join(
+            "%s %s\n" % (kind, " ".join(format_value(value) for value in values))
+            for kind, values in events
+        ).encode("utf8")
+
+
+class BinaryEncoder(object):
+    def __init__(self, fields=EVENT_FIELDS):
+        self.fields = fields
+        self.last_timestamp = 0
+
+    def header(self):
+        data = bytearray(MAGIC)
+        write_varint(data, VERSION)
+        write_varint(data, len(self.fields))
+        for kind, fields in self.fields.items():
+            write_varint(data, kind)
+            write_string(data, fields)
+        return bytes(data)
+
+    def encode(self, events):
+        data = bytearray()
+        for kind, values in events:
+            write_varint(data, kind)
+            for field, value in zip(self.fields[kind], values):
+                if field == "u":
+                    write_varint(data, value)
+                elif field == "t":
+                    write_varint(data, zigzag(value - self.last_timestamp))
+                    self.last_timestamp = value
+                elif field == "i":
+                    write_varint(data, zigzag(value))
+                elif field == "d":
+                    data += double.pack(value)
+                elif field == "L":
+                    write_varint(data, len(value))
+                    for item in value:
+                        write_varint(data, item)
+                else:
+                    write_string(data, str(value))
+        return bytes(data)
+
+
+def get_encoder(format):
+    if format == "text":
+        return TextEncoder()
+    if format == "binary":
+        return BinaryEncoder()
+    raise ValueError("unknown trace format '%s', use one of %s" % (format, ", ".join(FORMATS)))
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def write_varint(data, value):
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+
+
+def write_string(data, value):
+    encoded = value.encode("utf8")
+    write_varint(data, len(encoded))
+    data += encoded
+
+
+def read_varint(data, pos):
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    value = byte & 0x7F
+    shift = 7
+    while True:
+        pos += 1
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos + 1
+        shift += 7
+
+
+def read_string(data, pos):
+    size, pos = read_varint(data, pos)
+    end = pos + size
+    if end > len(data):
+        raise IncompleteRecord()
+    return data[pos:end].decode("utf8"), end
+
+
+def check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown compression '%s', use one of %s" % (compression, ", ".join(COMPRESSIONS)))
+
+
+def compress_frame(data, compression):
+    """Return data as one frame that can be decompressed on its own."""
+    if compression == "gzip":
+        return gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+    if compression == "zlib":
+        return zlib.compress(data, COMPRESS_LEVEL)
+    return data
+
+
+def is_compressed(data):
+    return data[:1] in FRAME_MARKERS
+
+
+class Inflater(object):
+    """Decompress a sequence of frames that arrives in pieces."""
+
+    def __init__(self):
+        self.inflater = zlib.decompressobj(FRAME_WBITS)
+
+    def feed(self, data):
+        result = []
+        while data:
+            result.append(self.inflater.decompress(data))
+            if not self.inflater.eof:
+                break
+            data = self.inflater.unused_data
+            self.inflater = zlib.decompressobj(FRAME_WBITS)
+        return b"".join(result)
+
+
+class FrameReader(io.RawIOBase):
+    """A file object that reads the decompressed contents of a compressed trace, up to its last complete frame."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.inflater = Inflater()
+        self.data = b""
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.pos == len(self.data):
+            raw = self.fp.read(CHUNK_SIZE)
+            if not raw:
+                return 0
+            self.data, self.pos = self.inflater.feed(raw), 0
+        count = min(len(buffer), len(self.data) - self.pos)
+        buffer[:count] = self.data[self.pos:self.pos + count]
+        self.pos += count
+        return count
+
+
+def open_frames(fp):
+    """Return a buffered file object that reads fp, decompressing it when needed."""
+    if not hasattr(fp, "peek"):
+        fp = io.BufferedReader(fp)
+    if is_compressed(fp.peek(1)):
+        fp = io.BufferedReader(FrameReader(fp), CHUNK_SIZE)
+    return fp
+
+
+def detect_format(fp):
+    """Return "binary" or "text" for the trace in the given binary file object without consuming it."""
+    return "binary" if fp.peek(len(MAGIC))[:len(MAGIC)] == MAGIC else "text"
+
+
+def read_events(fp, offsets=False):
+    """
+    Yield (kind, values) for every event in fp, an open binary file object in either format.
+
+    With offsets=True, yield (offset, kind, values) with the byte offset where each event starts.
+    Compressed traces are decompressed while reading, and their offsets count decompressed bytes.
+    """
+    fp = open_frames(fp)
+    if detect_format(fp) == "binary":
+        return read_binary_events(fp, offsets)
+    return read_text_events(fp, offsets)
+
+
+def read_events_at(fp, format, fields, offset, timestamp=0, end=None, offsets=False):
+    """Yield the events of a seekable fp from offset up to end, given the timestamp in effect at offset."""
+    fp.seek(offset)
+    if format == "binary":
+        return decode_binary(fp, fields, b"", offset, timestamp, end, offsets)
+    return read_text_events(fp, offsets, offset, end)
+
+
+def parse_text_line(line):
+    kind, _, rest = line.rstrip("\n").partition(" ")
+    kind = int(kind)
+    fields = EVENT_FIELDS[kind]
+    items = rest.split(" ", len(fields) - 1) if fields.endswith("s") else rest.split()
+    values = []
+    for field, item in zip(fields, items):
+        if field == "d":
+            values.append(float(item))
+        elif field == "s":
+            values.append(item)
+        elif field == "L":
+            values.append([int(value) for value in items[len(values):]])
+        else:
+            values.append(int(item))
+    return kind, values
+
+
+def read_text_events(fp, offsets=False, offset=0, end=None):
+    for line in fp:
+        start = offset
+        offset += len(line)
+        if end is not None and start >= end:
+            return
+        line = line.decode("utf8")
+        if not line.strip():
+            continue
+        try:
+            kind, values = parse_text_line(line)
+        except Exception as e:
+            print(f"Error handling line: '{line}': {e}")
+            continue
+        yield (start, kind, values) if offsets else (kind, values)
+
+
+def read_header(fp):
+    data = fp.read(CHUNK_SIZE)
+    pos = len(MAGIC)
+    version, pos = read_varint(data, pos)
+    if version > VERSION:
+        raise ValueError("trace format version %d is newer than supported version %d" % (version, VERSION))
+    count, pos = read_varint(data, pos)
+    fields = {}
+    for _ in range(count):
+        kind, pos = read_varint(data, pos)
+        fields[kind], pos = read_string(data, pos)
+    return fields, data[pos:], pos
+
+
+def read_binary_events(fp, offsets=False):
+    fields, data, offset = read_header(fp)
+    return decode_binary(fp, fields, data, offset, 0, None, offsets)
+
+
+def decode_calls(data, start, stop, base, offsets):
+    """Return the events of a run of call records with a one byte callsite."""
+    callsites = data[start + 1:stop:2]
+    if offsets:
+        return [(offset, EVENT_CALL, (callsite,)) for offset, callsite in zip(range(base + start, base + stop, 2), callsites)]
+    return [(EVENT_CALL, (callsite,)) for callsite in callsites]
+
+
+def decode_timestamp_calls(data, start, stop, base, timestamp, offsets):
+    """Return the events of a run of timestamp and call records with one byte fields, and the last timestamp."""
+    stamps = list(itertools.accumulate([(delta >> 1) ^ -(delta & 1) for delta in data[start + 1:stop:4]], initial=timestamp))
+    events = [None] * (len(stamps) - 1) * 2
+    if offsets:
+        events[0::2] = [(offset, EVENT_TIMESTAMP, (stamp,)) for offset, stamp in zip(range(base + start, base + stop, 4), stamps[1:])]
+        events[1::2] = [(offset, EVENT_CALL, (callsite,)) for offset, callsite in zip(range(base + start + 2, base + stop, 4), data[start + 3:stop:4])]
+    else:
+        events[0::2] = [(EVENT_TIMESTAMP, (stamp,)) for stamp in stamps[1:]]
+        events[1::2] = [(EVENT_CALL, (callsite,)) for callsite in data[start + 3:stop:4]]
+    return events, stamps[-1]
+
+
+def decode_binary(fp, fields, data, base, timestamp, end, offsets, state=None):
+    # base is the file offset of data[0], state receives what is left when fp runs dry
+    pos = 0
+    size = len(data)
+    while True:
+        start = pos
+        try:
+            if pos >= size:
+                raise IncompleteRecord()
+            if end is not None and base + start >= end:
+                return
+            kind = data[pos]
+            # runs of the two most frequent records are decoded in bulk, single records get a fast path
+            run = TIMESTAMP_CALLS.match(data, pos) if kind == EVENT_TIMESTAMP else CALLS.match(data, pos) if kind == EVENT_CALL else None
+            if run and (end is None or base + run.end() <= end):
+                pos = run.end()
+                if kind == EVENT_CALL:
+                    yield from decode_calls(data, start, pos, base, offsets)
+                    continue
+                events, timestamp = decode_timestamp_calls(data, start, pos, base, timestamp, offsets)
+                yield from events
+                continue
+            pos += 1
+            if kind > 0x7F:
+                kind, pos = read_varint(data, start)
+            if kind == EVENT_CALL:
+                callsite, pos = read_varint(data, pos)
+                yield (base + start, kind, (callsite,)) if offsets else (kind, (callsite,))
+                continue
+            if kind == EVENT_TIMESTAMP:
+                delta, pos = read_varint(data, pos)
+                timestamp += (delta >> 1) ^ -(delta & 1)
+                yield (base + start, kind, (timestamp,)) if offsets else (kind, (timestamp,))
+                continue
+            values = []
+            stamp = timestamp
+            for field in fields[kind]:
+                if field == "u":
+                    value, pos = read_varint(data, pos)
+                elif field == "t":
+                    value, pos = read_varint(data, pos)
+                    value = stamp = stamp + unzigzag(value)
+                elif field == "i":
+                    value, pos = read_varint(data, pos)
+                    value = unzigzag(value)
+                elif field == "d":
+                    if pos + 8 > size:
+                        raise IncompleteRecord()
+                    value, = double.unpack_from(data, pos)
+                    pos += 8
+                elif field == "L":
+                    count, pos = read_varint(data, pos)
+                    value = list(data[pos:pos + count])
+                    if len(value) == count and max(value, default=0) < 0x80:
+                        pos += count
+                    else:
+                        value = []
+                        for _ in range(count):
+                            item, pos = read_varint(data, pos)
+                            value.append(item)
+                else:
+                    value, pos = read_string(data, pos)
+                values.append(value)
+            timestamp = stamp
+            yield (base + start, kind, values) if offsets else (kind, values)
+        except (IncompleteRecord, IndexError):
+            more = fp.read(CHUNK_SIZE)
+            if not more:
+                if state is not None:
+                    state["rest"] = data[start:]
+                    state["timestamp"] = timestamp
+                return
+            data = data[start:] + more
+            base += start
+            size = len(data)
+            pos = 0
+
+
+class StreamDecoder(object):
+    """Decode a trace that arrives in pieces, such as a followed remote trace, in either format."""
+
+    def __init__(self):
+        self.format = None
+        self.fields = None
+        self.inflater = None
+        self.data = b""
+        self.timestamp = 0
+
+    def feed(self, data):
+        """Return the events completed by data, keeping any partial event for the next call."""
+        if self.inflater is None and data:
+            self.inflater = Inflater() if is_compressed(data) else False
+        if self.inflater:
+            data = self.inflater.feed(data)
+        self.data += data
+        if self.format is None:
+            if len(self.data) < len(MAGIC) and MAGIC.startswith(self.data):
+                return []
+            self.format = "binary" if self.data.startswith(MAGIC) else "text"
+        if self.format == "text":
+            lines = self.data.split(b"\n")
+            self.data = lines.pop()
+            events = []
+            for line in lines:
+                if line.strip():
+                    events.append(parse_text_line(line.decode("utf8")))
+            return events
+        if self.fields is None:
+            try:
+                self.fields, self.data, _ = read_header(io.BytesIO(self.data))
+            except (IncompleteRecord, IndexError):
+                return []
+        state = {}
+        events = list(decode_binary(io.BytesIO(), self.fields, self.data, 0, self.timestamp, None, False, state))
+        self.data = state["rest"]
+        self.timestamp = state["timestamp"]
+        return events
+
+
+def write_events(fp, events, format, compression="none"):
+    encoder = get_encoder(format)
+    fp.write(compress_frame(encoder.header(), compression))
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) == 100000:
+            fp.write(compress_frame(encoder.encode(batch), compression))
+            batch = []
+    fp.write(compress_frame(encoder.encode(batch), compression))
+
+
+def find_shards(input_file):
+    """Return (pid, path) for the traces that child processes wrote next to input_file."""
+    path = pathlib.Path(input_file)
+    shards = []
+    for shard in path.parent.glob(f"{path.stem}.*{path.suffix}"):
+        pid = shard.name[len(path.stem) + 1:len(shard.name) - len(path.suffix)]
+        if pid.isdigit():
+            shards.append((int(pid), shard))
+    return sorted(shards)
+
+
+def read_shards(input_file, first_when, read):
+    """Call read(pid, events, first_when) for the trace of every child process of input_file."""
+    # children record on the clock of the parent, so their times count from its first timestamp
+    for pid, shard in find_shards(input_file):
+        with open(shard, "rb") as fp:
+            read(pid, read_events(fp), first_when)
+
+
+def convert(input_file, output_file, format, compression="none"):
+    """Convert a trace in either format, compressed or not, into the given format and compression."""
+    check_compression(compression)
+    with open(input_file, "rb") as fin, open(output_file, "wb") as fout:
+        write_events(fout, read_events(fin), format, compression)